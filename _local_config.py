@@ -16,6 +16,14 @@ gr_db_connection_string = Template(databaseStringTemplate).safe_substitute({**co
 # Tracker DB
 tk_db_connection_string = Template(databaseStringTemplate).safe_substitute({**conns['local_postgres_con'], "database": "testing"})
 
+# connection pool settings for each db engine (passed to create_engine),
+# default is used for any other connection string
+db_pool_config = {
+    'tk': {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 30, 'pool_recycle': 1800},
+    'gr': {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30, 'pool_recycle': 1800},
+    'default': {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30, 'pool_recycle': 1800}
+}
+
 # JIRA connection
 jira_config = {**conns['ldap'], 'url' : 'https://jira.extge.co.uk'}
 
@@ -26,6 +34,94 @@ jira_config = {**conns['ldap'], 'url' : 'https://jira.extge.co.uk'}
 # folder to put image exports of the consent form pages
 image_store_dir = '/Users/simonthompson/scratch/temp'
 
+# folder for the page cache of rendered pages and analysis keyed by file
+# md5, None turns the cache off. Least recently used entries are evicted once
+# it grows over max_bytes
+cache_config = {
+    'dir': '/Users/simonthompson/scratch/page_cache',
+    'max_bytes': 20 * 1024 ** 3
+}
+
+# folder for the page store of raw grayscale pages keyed by attachment uid,
+# kept so pages can be cropped again without re-rendering. None turns the
+# store off. The pages are uncompressed at full resolution (around 4MB per
+# A4 page at 200 dpi) and nothing is ever evicted, so it is off by default
+page_store_config = {
+    'dir': None
+}
+
+##-- Rasterisation
+# if targeted, only the inspected pages are rendered at inspection_dpi, the
+# remaining pages (only used for empty page checks and archive images) are
+# rendered at check_dpi, all straight to grayscale. This makes the archive
+# images (and page store) of those pages lower resolution, so is off by
+# default. If disk_format is 'pgm' or 'png' the pages are rendered straight
+# to image_store_dir rather than into memory, pgm pages are then memory
+# mapped when needed
+rasterise_config = {
+    'targeted': False,
+    'disk_format': None,
+    'inspection_pages': 1,
+    'inspection_dpi': 200,
+    'check_dpi': 72
+}
+
+##-- Page analysis
+# pages with a standard deviation of pixel values below minsd are empty
+analysis_config = {
+    'minsd': 10
+}
+
+##-- Page export
+# if archive is set all the pages of an attachment are exported to a single
+# <attachment uid>.pages file in image_store_dir (with an offset table for
+# random access) rather than a png file per page
+export_config = {
+    'archive': False
+}
+
+##-- PNG encoding
+# used for the exported page images and the crops uploaded to JIRA. Lower
+# compress_level (0-9) is quicker but makes bigger files. mode None keeps 8-bit
+# grayscale, '1' makes 1-bit images (pixels below threshold are black) and
+# 'P' a palette of colors gray levels, both much smaller for scanned forms
+png_config = {
+    'compress_level': 6,
+    'mode': None,
+    'threshold': 128,
+    'colors': 16
+}
+
+##-- Crop templates
+# regions of each version of the consent form to crop for the inspection
+# ticket, keyed by the ConsentQuestionnaire version or title in GR (matched
+# ignoring case, version first). default is used for forms that can't be
+# matched. x, y, w and h are proportions of the page, fw the width in pixels
+crop_templates = {
+    'default': [
+        {'name': 'inspection', 'page': 1, 'x': 0.5, 'y': 0.5, 'w': 0.25,
+         'h': 0.25, 'fw': 150}
+    ]
+}
+
+##-- JIRA uploads
+# number of images uploaded to a new ticket at once
+jira_upload_config = {
+    'workers': 4
+}
+
+##-- JIRA ticket sync
+# incremental syncs ask JIRA for the tickets updated since the last
+# successful sync, less overlap_minutes to allow for clock differences and
+# JQL only comparing to the minute. Tickets in one of the terminal_statuses
+# are left out of routine syncs, and only checked by a full audit sweep of
+# every ticket once every audit_days
+jira_sync_config = {
+    'overlap_minutes': 10,
+    'terminal_statuses': ['Done', 'Closed', "Won't Do"],
+    'audit_days': 7
+}
+
 ##-- JIRA jsql strings
 # JQL to get any consent form faults generated from consent form check tickets
 consent_form_check_errors = 'project%20%3D%20"Clinical%20Data%20Wranglers%20%26%20Modellers"%20and%20summary%20~%20%27Consent%20Form%20Fault%27'
@@ -4,10 +4,16 @@ project to coordinate inspection of the GMS consent forms
 
 import subprocess
 import logging
+import concurrent.futures
+import datetime
+import os
+import time
 import fire
-from modules import log, attachment, jira, tickets
+from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import load_only
+from modules import log, attachment, jira, tickets, pool, pipeline, watermark, bulk, templates
 import local_config
-from models import getEngine, makeSession, tk_db, gr_db
+from models import getEngine, makeSession, logPoolMetrics, tk_db, gr_db
 
 LOGGER = logging.getLogger(__name__)
 
@@ -49,6 +55,73 @@ def list_to_table(l):
     return '\n'.join(out)
 
 
+def get_new_gr_attachments(s, incremental, chunk_size=1000):
+    """
+    get the consent forms in the GR database that haven't been processed yet
+    :params s: SQLAlchemy session bound to both dbs
+    :params incremental: if True only the rows changed since the
+    gr_attachment watermark are scanned, and those already in the tracker db
+    are dropped by a lookup on just that delta. Rows with neither
+    last_updated nor attachment_created set have no timestamp to compare, so
+    are included in every scan (and dropped again once in the tracker db)
+    :params chunk_size: number of uids to look up in the tracker db at once
+    :returns: list of gr_db.Attachment in order of last change
+    """
+
+    LOGGER.info('Received call to get_new_gr_attachments, incremental %s',
+                incremental)
+
+    # query GR database to get all the consent forms with relevant title,
+    # only loading the columns we need (attachment_data is only loaded if
+    # there's no url)
+    q = s.query(gr_db.Attachment).\
+        options(load_only('uid', 'attachment_url', 'last_updated',
+                          'attachment_created')).\
+        filter(gr_db.Attachment.attachment_title ==
+               'record-of-discussion-form.pdf')
+
+    # either way the rows come back oldest change first
+    ts = func.coalesce(gr_db.Attachment.last_updated,
+                       gr_db.Attachment.attachment_created)
+
+    if not incremental:
+
+        # get the attachments that have already been processed and leave
+        # those out
+        db_attachments = s.query(tk_db.Attachment.uid).all()
+        db_attachments = [x[0] for x in db_attachments]
+
+        return q.filter(gr_db.Attachment.uid.notin_(db_attachments)).\
+            order_by(ts).all()
+
+    # only scan the rows changed since the watermark, >= so rows sharing the
+    # watermark's timestamp that arrived after the last run aren't missed.
+    # The filter is written against last_updated directly so its index can
+    # be used
+    wm = watermark.get_watermark(s, 'gr_attachment')
+
+    if wm is not None:
+        q = q.filter(or_(
+            gr_db.Attachment.last_updated >= wm,
+            and_(gr_db.Attachment.last_updated.is_(None),
+                 or_(gr_db.Attachment.attachment_created >= wm,
+                     gr_db.Attachment.attachment_created.is_(None)))))
+
+    delta = q.order_by(ts).all()
+
+    LOGGER.info('%s GR attachments changed since %s', len(delta), wm)
+
+    # find which of the delta are already in the tracker db
+    db_attachments = set()
+    for i in range(0, len(delta), chunk_size):
+        u = [x.uid for x in delta[i:i + chunk_size]]
+        db_attachments.update(
+            str(x[0]) for x in s.query(tk_db.Attachment.uid).
+            filter(tk_db.Attachment.uid.in_(u)))
+
+    return [x for x in delta if str(x.uid) not in db_attachments]
+
+
 # Fire class of commandline arguments
 class ConsInsp(object):
 
@@ -79,101 +152,291 @@ class ConsInsp(object):
         db_tickets = s.query(tk_db.Ticket.ticket_key).all()
         db_tickets = [x[0] for x in db_tickets]
 
+        # collect the error rows to write in bulk
+        w = bulk.BulkWriter()
+
         # iterate through the new tickets
         for t in set(all_tickets) - set(db_tickets):
 
             # add the new ticket to the db
             n = tickets.NewTicket(t)
-            n.update_db(s, 'inspection_fault')
+            n.update_db(s, 'inspection_fault', w)
 
+        w.write(s)
         s.commit()
+        logPoolMetrics()
 
 
-    def update_tickets(self):
+    def update_tickets(self, workers=8, rate=20, search=True,
+                       incremental=True, audit=False):
         """
         Fetch all the tickets we know about and update details in db
+        :params workers: maximum number of JIRA requests in flight at once
+        :params rate: maximum number of JIRA requests started per second,
+        None for no limit
+        :params search: if True tickets are fetched 100 at a time through the
+        JIRA search API, otherwise with a request per ticket
+        :params incremental: if True (and searching) only the tickets updated
+        in JIRA since the jira_tickets watermark are fetched and updated
+        :params audit: if True do a full audit sweep of every ticket, including
+        those in a terminal status, regardless of when the last one was
         """
 
         s = makeSession()
+        st = time.perf_counter()
+        c = local_config.jira_sync_config
+
+        # the watermark is when the most recently updated ticket JIRA
+        # returns was updated (in UTC), so it's on JIRA's clock rather than
+        # this host's. The time the sync started dates the audit sweep
+        started = datetime.datetime.today()
+        wm = None
+        since = None
+
+        # tickets in a terminal status are only checked by an audit sweep,
+        # which is a full sync of every ticket made every audit_days. The
+        # watermarks are only used (and kept) by an incremental sync
+        if incremental:
+
+            wm = watermark.get_watermark(s, 'jira_tickets')
+            last_audit = watermark.get_watermark(s, 'jira_tickets_audit')
+            audit = audit or last_audit is None or started - last_audit >= \
+                datetime.timedelta(days=c['audit_days'])
+
+            if search and wm is not None and not audit:
+                since = wm - datetime.timedelta(minutes=c['overlap_minutes'])
+
+        # get the tickets from db, leaving out those in a terminal status
+        # unless this is an audit sweep
+        q = s.query(tk_db.Ticket)
+
+        if not audit:
+            q = q.filter(or_(
+                tk_db.Ticket.ticket_status.is_(None),
+                tk_db.Ticket.ticket_status.notin_(c['terminal_statuses'])))
+
+        existing_tickets = q.all()
+
+        # fetch the details of every ticket from JIRA concurrently, the
+        # session is only used here on the coordinator
+        keys = [x.ticket_key for x in existing_tickets]
+
+        if search:
+            details = tickets.search_tickets(keys, workers=workers, rate=rate,
+                                             updated_since=since)
+        else:
+            details = tickets.fetch_tickets(keys, workers, rate,
+                                            tickets.ExistingTicket.fields +
+                                            ['updated'])
 
-        # get all the tickets from db
-        existing_tickets = s.query(tk_db.Ticket)
-
-        # update each ticket
+        # update each ticket, in an incremental sync only those JIRA returned
+        # have changed
+        n = 0
         for t in existing_tickets:
 
-            e = tickets.ExistingTicket(t)
+            if since is not None and t.ticket_key not in details:
+                continue
+
+            e = tickets.ExistingTicket(t, details)
             e.update_db()
+            n += 1
+
+        if incremental:
+
+            # never moved back, e.g. by a sync that left out the ticket
+            # updated last
+            u = tickets.latest_updated(details)
+            if u is not None and (wm is None or u > wm):
+                watermark.set_watermark(s, 'jira_tickets', u)
+
+            if audit:
+                watermark.set_watermark(s, 'jira_tickets_audit', started)
 
         s.commit()
 
+        # log the throughput for tuning workers and rate
+        seconds = time.perf_counter() - st
+        LOGGER.info('Synced %s tickets (%s updated since %s) in %.2fs (%.1f tickets/s); workers %s, rate %s, search %s, audit %s',
+                    len(existing_tickets), n, since, seconds,
+                    len(existing_tickets) / seconds, workers, rate, search,
+                    audit)
+        logPoolMetrics()
+
 
-    def process_new_consent_forms(self):
+    def process_new_consent_forms(self, workers=1, prefetch=2,
+                                  render_threads=1, incremental=True):
         """
         Identify new consent forms and extract relevant parts into single
         inspection ticket
+        :params workers: number of workers to download and render attachments
+        with, 1 streams the attachments through the pipeline
+        :params prefetch: number of attachments the pipeline downloads ahead
+        of the one being rasterised
+        :params render_threads: number of poppler processes to split the pages
+        of each document across
+        :params incremental: only scan the GR attachments changed since the
+        last run (as recorded by the gr_attachment watermark)
         """
 
         s = makeSession()
+        st = time.perf_counter()
 
-        # get the attachments that have already been processed
-        db_attachments = s.query(tk_db.Attachment.uid).all()
-        db_attachments = [x[0] for x in db_attachments]
+        # get all the consent forms that should be inspected
+        #TODO: remove limit here when we are over testing
+        new_gr_attachments = get_new_gr_attachments(s, incremental)[0:10]
+
+        # get the participant details for the whole batch at once
+        patients = attachment.get_patients_info(
+            s, [attachment.uids_from_attachment_url(x.attachment_url)[0]
+                for x in new_gr_attachments
+                if x.attachment_url is not None])
 
-        # query GR database to get all the consent forms that should be inspected
-        # i.e. relevant title and not in db_attachments
-        new_gr_attachments = s.query(gr_db.Attachment).\
-            filter(gr_db.Attachment.attachment_title ==
-                   'record-of-discussion-form.pdf').\
-            filter(gr_db.Attachment.uid.notin_(db_attachments))
+        # get the regions to crop for each attachment from its form version
+        crop_regions = templates.resolve_templates(
+            s, [x.uid for x in new_gr_attachments])
 
         # create objects that will be added to during processing
+        w = bulk.BulkWriter()
         attachment_objects = []
         jira_table = [['id', 'name', 'dob', 'image', 'fault link']]
         image_crops = []
 
-        # iterate over each of the attachments in the query
-        #TODO: remove limit here when we are over testing
-        for i in new_gr_attachments[0:10]:
-
-            # create instance of attachment class, doing so will do some
-            # initial processing of the document
-            c = attachment.Attachment(i, s)
-
-            # extract participant info from GR db for the matching participant
-            c.get_patient_info(s)
+        # create instance of attachment class for each of the attachments in
+        # the query, processing of the document is done either through the
+        # worker pool or by streaming the attachments through the pipeline
+        if workers > 1:
+            processed_attachments = pool.process_attachments(
+                [attachment.Attachment(i, s, process=False,
+                                       render_threads=render_threads,
+                                       writer=w)
+                 for i in new_gr_attachments], workers)
+        else:
+            processed_attachments = pipeline.run_pipeline(
+                (attachment.Attachment(i, s, process=False,
+                                       render_threads=render_threads,
+                                       writer=w)
+                 for i in new_gr_attachments), prefetch)
+
+        # iterate over each of the processed attachments
+        n = 0
+        last_change = None
+        for c in processed_attachments:
+
+            # extract participant info for the matching participant
+            c.get_patient_info(s, patients)
+
+            # check the document has every page its template crops from
+            regions = crop_regions[str(c.gr_attachment.uid)]
+            if not c.errored and \
+                    any(r.page > len(c.pages) for r in regions):
+                c.log_error('crop page out of range')
 
             if not c.errored:
 
                 # if no errors have been raised then we can go ahead and add
-                # it to what will go into the inspection ticket
+                # it to what will go into the inspection ticket, with a crop
+                # of each region in its form version's template
+                crops = [('%s_%s.png' % (c.attachment_id, r.name),
+                          c.crop_png(r.page, r.x, r.y, r.w, r.h, r.fw, r.name))
+                         for r in regions]
                 jira_table.append([str(c.attachment_id), c.person_name, c.dob,
-                                   '!%s.png!' % c.attachment_id,
+                                   ' '.join('!%s!' % x[0] for x in crops),
                                    '[Fault|%s]' % c.create_fault_ticket_url()])
-                image_crops.append(('%s.png' % c.attachment_id,
-                                    c.crop_page(1, 0.5, 0.5, 0.25, 0.25, 150)))
+                image_crops.extend(crops)
                 attachment_objects.append(c)
 
             else:
 
                 # if there are errors then we create an error ticket
-                e = jira.ErrorTicket(s, c)
+                e = jira.ErrorTicket(s, c, w)
                 e.create_ticket()
 
-            # add details of the attachment to the database
-            c.add_pages_to_db()
+            # add details of the attachment to the database, then the page
+            # arrays are no longer needed
+            c.add_pages_to_db(w)
+            c.release_pages()
+            n += 1
+
+            # keep track of the latest change ingested
+            ts = c.gr_attachment.last_updated or \
+                c.gr_attachment.attachment_created
+            if ts is not None and (last_change is None or ts > last_change):
+                last_change = ts
+
+        LOGGER.info('Processed %s attachments in %.2fs; workers %s, prefetch %s, render_threads %s',
+                    n, time.perf_counter() - st, workers, prefetch,
+                    render_threads)
 
         if len(attachment_objects):
 
             # if we actually have any documents to inspect then we go ahead
             # and create an inspection ticket and add the attachments
             t = jira.InspectionTicket(s, jira_table, attachment_objects)
-            t.tracking_db_ticket.attachments = [
-                x.index_attachment for x in attachment_objects]
             t.ticket_image_attachments = image_crops
             t.create_ticket()
 
+        # move the watermark on to the latest change ingested, only from an
+        # incremental run so a full scan can't skip it past rows not yet
+        # processed
+        if incremental and last_change is not None:
+            watermark.set_watermark(s, 'gr_attachment', last_change)
+
+        # write the attachment, page and error rows for the whole batch
+        w.write(s)
         s.commit()
+        logPoolMetrics()
+
+
+    def recrop(self, x=0.5, y=0.5, w=0.25, h=0.25, fw=150, p=1, workers=8,
+               folder=None, chunk_size=1000):
+        """
+        crop the pages already processed again with new crop parameters, the
+        pages are loaded from the page store or the exported images, never
+        from S3 or by rendering the original file
+        :params x: top left corner to start crop as proportion of page width
+        :params y: top left corner to start crop as proportion of page width
+        :params w: proportion of page width to include in crop
+        :params h: proportion of page height to include in crop
+        :params fw: final width of image in pixels to crop to
+        :params p: page number to crop
+        :params workers: number of pages to load and crop at once
+        :params folder: folder to save the crops to, defaults to recrop in the
+        image store directory
+        :params chunk_size: number of pages to hand to the workers at once
+        """
+
+        LOGGER.info('Running recrop of page %s - %s, %s, %s, %s to width %s',
+                    p, x, y, w, h, fw)
+
+        # check the crop describes a region of a page before starting
+        templates.make_region({'name': 'recrop', 'page': p, 'x': x, 'y': y,
+                               'w': w, 'h': h, 'fw': fw})
+
+        s = makeSession()
+        st = time.perf_counter()
+
+        folder = folder or '%s/recrop' % local_config.image_store_dir
+        os.makedirs(folder, exist_ok=True)
+
+        # get the stored pages to crop
+        rows = s.query(tk_db.Page.attachment_uid, tk_db.Page.path).\
+            filter(tk_db.Page.page_number == p).all()
+
+        # load and crop the pages in a thread pool, a chunk at a time
+        n = 0
+        with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+
+            for i in range(0, len(rows), chunk_size):
+
+                n += sum(c is not None for c in ex.map(
+                    lambda r: attachment.recrop_page(
+                        r[0], p, r[1], x, y, w, h, fw, folder),
+                    rows[i:i + chunk_size]))
+
+        # log the throughput
+        seconds = time.perf_counter() - st
+        LOGGER.info('Recropped %s of %s pages in %.2fs (%.1f pages/s) to %s; workers %s',
+                    n, len(rows), seconds, n / seconds, folder, workers)
 
 
     def create_tracker_db(self):
@@ -183,7 +446,7 @@ class ConsInsp(object):
 
         LOGGER.info('Running recreateTrackerDB')
 
-        e = getEngine(local_config.tk_db_connection_string)
+        e = getEngine(local_config.tk_db_connection_string, 'tk')
         tk_db.metadata.drop_all(e)
         tk_db.metadata.create_all(e)
 
@@ -1,22 +1,138 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 import logging
+import threading
+import time
 from models import tk_db, gr_db
-from local_config import tk_db_connection_string, gr_db_connection_string
+from local_config import tk_db_connection_string, gr_db_connection_string, db_pool_config
 
 logger = logging.getLogger(__name__)
 
+# engines are created once per connection string and reused, along with the
+# metrics for their connection pools
+engines = {}
+poolMetrics = {}
+
+# session factory shared by everything that needs a session, binds are
+# configured on first use
+Session = sessionmaker()
+sessionConfigured = False
+
+
+class PoolMetrics:
+    """
+    Connection pool metrics for an engine
+
+    Attributes:
+        name: the name of the pool config the engine was created with
+        connects: number of new DBAPI connections made
+        checkouts: number of connections checked out of the pool
+        wait_total: total seconds spent waiting to check out a connection
+        wait_max: longest wait to check out a connection
+        held_total: total seconds connections were checked out for
+    """
+
+    def __init__(self, name):
+
+        self.name = name
+        self.connects = 0
+        self.checkouts = 0
+        self.wait_total = 0
+        self.wait_max = 0
+        self.held_total = 0
+        self.lock = threading.Lock()
+
+    def add_wait(self, seconds):
+        """
+        record a checkout and the time spent waiting for it
+        :params seconds: time spent waiting
+        """
+
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def add_held(self, seconds):
+        """
+        record the time a connection was checked out for
+        :params seconds: time checked out
+        """
+
+        with self.lock:
+            self.held_total += seconds
+
+    def add_connect(self):
+        """
+        record a new DBAPI connection
+        """
+
+        with self.lock:
+            self.connects += 1
+
+    def __repr__(self):
+        return('<PoolMetrics %s - %s connects, %s checkouts, wait %.3fs total %.3fs max, held %.3fs>' %
+               (self.name, self.connects, self.checkouts, self.wait_total,
+                self.wait_max, self.held_total))
+
+
+def timedPoolClass(m):
+    """get a QueuePool class that records checkout waits in the given metrics"""
+
+    class TimedQueuePool(QueuePool):
+
+        def _do_get(self):
+            st = time.perf_counter()
+            try:
+                return QueuePool._do_get(self)
+            finally:
+                m.add_wait(time.perf_counter() - st)
+
+    return TimedQueuePool
+
+
 def makeSession():
     """get session for all bound dbs"""
+    global sessionConfigured
     logger.info('Received call to makeSession')
-    session = sessionmaker()
-    session.configure(binds = {
-        tk_db.Base : getEngine(tk_db_connection_string),
-        gr_db.Base : getEngine(gr_db_connection_string)
-    })
-    return session()
-
-def getEngine(conn):
-    """get an engine for the given connection string"""
+    if not sessionConfigured:
+        Session.configure(binds = {
+            tk_db.Base : getEngine(tk_db_connection_string, 'tk'),
+            gr_db.Base : getEngine(gr_db_connection_string, 'gr')
+        })
+        sessionConfigured = True
+    return Session()
+
+def getEngine(conn, name = 'default'):
+    """get the engine for the given connection string, creating it on first
+    use with the pool settings in db_pool_config[name]"""
     logger.debug('Received call to getEngine for %s' % conn)
-    return create_engine(conn, echo = False)
+    if conn not in engines:
+        m = PoolMetrics(name)
+        c = db_pool_config.get(name, db_pool_config['default'])
+        e = create_engine(conn, echo = False, poolclass = timedPoolClass(m),
+                          pool_pre_ping = True, **c)
+
+        @event.listens_for(e, 'connect')
+        def onConnect(dbapi_connection, connection_record):
+            m.add_connect()
+
+        @event.listens_for(e, 'checkout')
+        def onCheckout(dbapi_connection, connection_record, connection_proxy):
+            connection_record.info['checkout_time'] = time.perf_counter()
+
+        @event.listens_for(e, 'checkin')
+        def onCheckin(dbapi_connection, connection_record):
+            st = connection_record.info.pop('checkout_time', None)
+            if st is not None:
+                m.add_held(time.perf_counter() - st)
+
+        engines[conn] = e
+        poolMetrics[conn] = m
+    return engines[conn]
+
+def logPoolMetrics():
+    """log the connection pool metrics for each engine"""
+    for m in poolMetrics.values():
+        logger.info(m)
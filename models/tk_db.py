@@ -69,3 +69,13 @@ class Ticket(Base):
     # one-to-many relationship with attachments and errors
     attachments = relationship('Attachment', backref='ticket_attachment')
     errors = relationship('Error', backref='ticket_error')
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    __table_args__ = {'schema': 'gms_consent_inspection_tracker'}
+
+    sync_name = Column(String, primary_key=True)
+    sync_watermark = Column(DateTime)
+    sync_updated = Column(DateTime)
+    de_datetime = Column(DateTime, nullable=False, default=datetime.datetime.now())
@@ -0,0 +1,101 @@
+"""
+provides vectorised analysis of the pages of a document, the pages are
+sampled onto a grid of the same size and stacked so the ink coverage and
+orientation of every page are worked out in one pass. The pixel spread is
+worked out exactly on each page, as sampling aliases with regular content
+such as lines of text
+"""
+import logging
+import numpy as np
+import cv2
+
+LOGGER = logging.getLogger(__name__)
+
+# per-page analysis record
+# std - standard deviation of the pixel values
+# ink - proportion of sampled pixels darker than the ink level
+# landscape - whether the page is wider than it is tall
+# empty - whether the page is thought to be empty
+PAGE_RECORD = np.dtype([('std', np.float32), ('ink', np.float32),
+                        ('landscape', np.bool_), ('empty', np.bool_)])
+
+
+def sample_pages(pages, size=256):
+    """
+    sample each page onto a size x size grid and stack them. Nearest
+    neighbour sampling picks out actual pixels, so the spread of values stays
+    representative of the full page (averaging would smooth it out)
+    :params pages: list of grayscale numpy arrays
+    :params size: width and height of the grid
+    :returns: numpy array of shape (number of pages, size, size)
+    """
+
+    LOGGER.debug('Received call to sample_pages for %s pages', len(pages))
+
+    s = np.empty((len(pages), size, size), dtype=np.uint8)
+
+    for i in range(len(pages)):
+        s[i] = cv2.resize(pages[i], (size, size),
+                          interpolation=cv2.INTER_NEAREST)
+
+    return s
+
+
+def page_std(page):
+    """
+    get the standard deviation of the pixel values of a page, as np.std but
+    in a single pass without converting the page to floats
+    :params page: grayscale numpy array
+    :returns: standard deviation
+    """
+
+    return cv2.meanStdDev(np.asarray(page))[1][0, 0]
+
+
+def analyse_stack(pages, minsd=10, ink_level=128, size=256):
+    """
+    analyse all the pages of a document in one pass
+    :params pages: list of grayscale numpy arrays
+    :params minsd: cut-off standard deviation for pixel values to be
+    considered empty
+    :params ink_level: pixel value below which a pixel is counted as ink
+    :params size: width and height of the grid pages are sampled onto
+    :returns: numpy structured array of PAGE_RECORD, one per page
+    """
+
+    LOGGER.debug('Received call to analyse_stack for %s pages', len(pages))
+
+    r = np.zeros(len(pages), dtype=PAGE_RECORD)
+
+    if not len(pages):
+        return r
+
+    s = sample_pages(pages, size)
+    shapes = np.array([x.shape for x in pages])
+
+    r['std'] = [page_std(x) for x in pages]
+    r['ink'] = (s < ink_level).mean(axis=(1, 2))
+    r['landscape'] = shapes[:, 1] > shapes[:, 0]
+    r['empty'] = r['std'] < minsd
+
+    return r
+
+
+def rotate_landscape_pages(pages, landscape):
+    """
+    rotate any landscape pages by 90 degrees anticlockwise (as np.rot90),
+    cv2.rotate gives a contiguous array rather than a view that would need
+    copying later
+    :params pages: list of grayscale numpy arrays
+    :params landscape: boolean array of which pages are landscape
+    :returns: list of pages with any landscape pages rotated
+    """
+
+    for i in np.flatnonzero(landscape):
+
+        LOGGER.debug('Rotating page number %s', (i+1))
+
+        pages[i] = cv2.rotate(np.asarray(pages[i]),
+                              cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+    return pages
@@ -0,0 +1,144 @@
+"""
+provides a compact archive of the page images of an attachment, all the
+pages are held in a single file rather than a PNG per page, which keeps the
+file count of the image store down. Each page is stored PNG encoded, and an
+offset table at the end of the file gives random access to any page
+
+The file is laid out as:
+    MAGIC, then the encoded pages one after another, then the offset table
+    (a little endian uint64 offset and length per page), then a footer of the
+    number of pages and the offset of the table (both uint64) and MAGIC
+
+A page within an archive is referred to as <archive path>#<page number>,
+which is what is recorded in tk_db.Page.path
+"""
+import io
+import logging
+import os
+import struct
+import numpy as np
+from PIL import Image
+from modules import encode, render
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'CIPA'
+FOOTER = struct.Struct('<QQ4s')
+
+
+def page_ref(fn, n):
+    """
+    make the reference to a page within an archive
+    :params fn: path of the archive
+    :params n: page number, starting at 1
+    :returns: reference string
+    """
+
+    return '%s#%s' % (fn, n)
+
+
+def split_ref(ref):
+    """
+    split a page reference into the archive path and page number
+    :params ref: reference string made by page_ref
+    :returns: tuple of archive path and page number, page number is None if
+    the reference is a plain image file path
+    """
+
+    fn, sep, n = ref.rpartition('#')
+
+    if not sep or not n.isdigit():
+        return ref, None
+
+    return fn, int(n)
+
+
+def write_archive(fn, pages, level=None, mode=None):
+    """
+    write the pages of an attachment to an archive, through a temporary file
+    so a partial archive is never left in place
+    :params fn: path of the archive
+    :params pages: list of grayscale numpy arrays
+    :params level: zlib compression level, as encode.encode_png
+    :params mode: None, '1' or 'P', as encode.encode_png
+    :returns: list of page references, one per page
+    """
+
+    LOGGER.debug('Received call to write_archive for %s pages - %s',
+                 len(pages), fn)
+
+    index = np.zeros((len(pages), 2), dtype='<u8')
+
+    with open(fn + '.tmp', 'wb') as f:
+
+        f.write(MAGIC)
+
+        # write each page, recording where it went
+        for i in range(len(pages)):
+            b = encode.encode_png(pages[i], level, mode)
+            index[i] = f.tell(), len(b)
+            f.write(b)
+
+        # then the offset table and footer
+        t = f.tell()
+        f.write(index.tobytes())
+        f.write(FOOTER.pack(len(pages), t, MAGIC))
+
+    os.replace(fn + '.tmp', fn)
+
+    return [page_ref(fn, i + 1) for i in range(len(pages))]
+
+
+def read_index(f):
+    """
+    read the offset table of an open archive
+    :params f: archive file object opened in binary mode
+    :returns: numpy array of shape (number of pages, 2) of offset and length
+    """
+
+    f.seek(-FOOTER.size, os.SEEK_END)
+    n, t, m = FOOTER.unpack(f.read(FOOTER.size))
+
+    if m != MAGIC:
+        raise ValueError('%s is not a page archive' % f.name)
+
+    f.seek(t)
+
+    return np.frombuffer(f.read(16 * n), dtype='<u8').reshape(n, 2)
+
+
+def read_page_bytes(fn, n):
+    """
+    read the encoded image of a single page from an archive
+    :params fn: path of the archive
+    :params n: page number, starting at 1
+    :returns: Bytes object with PNG format
+    """
+
+    with open(fn, 'rb') as f:
+
+        index = read_index(f)
+
+        if not 1 <= n <= len(index):
+            raise IndexError('page %s not in %s' % (n, fn))
+
+        f.seek(int(index[n - 1, 0]))
+
+        return f.read(int(index[n - 1, 1]))
+
+
+def load_page(ref):
+    """
+    load a page as a grayscale numpy array from a tk_db.Page.path, which can
+    be an archive page reference or a plain image file path
+    :params ref: page reference or image file path
+    :returns: grayscale numpy array
+    """
+
+    fn, n = split_ref(ref)
+
+    if n is None:
+        return render.load_page(fn)
+
+    return np.array(Image.open(io.BytesIO(read_page_bytes(fn, n))).
+                    convert('L'))
@@ -5,23 +5,535 @@ import numpy as np
 import cv2
 import logging
 import os
+import shutil
 from botocore.exceptions import ClientError
 from PIL import Image
 import tempfile
 from models import tk_db, gr_db
-from modules import s3
+from modules import s3, render, analysis, cache, encode, archive, pagestore, templates, uids
 import local_config
 import urllib.parse
 import random
+import time
+from sqlalchemy import func
+from sqlalchemy.orm import object_session
 
 LOGGER = logging.getLogger(__name__)
 
+# bytes of an inline attachment to read per query
+INLINE_CHUNK = 1 << 20
+
+
+def convert_to_gray(i):
+    """
+    convert image as np array to grayscale
+    :params i: numpy array of image
+    :returns: grayscale image
+    """
+
+    return cv2.cvtColor(i, cv2.COLOR_BGR2GRAY)
+
+
+def make_image_folder(attachment_id):
+    """
+    create the folder in the image store directory for an attachment's pages
+    :params attachment_id: the attachment_id the pages belong to
+    :returns: path to the folder
+    """
+
+    f = '%s/%s' % (local_config.image_store_dir, attachment_id)
+
+    # try to create the folder, carry on if folder already exists
+    try:
+
+        os.mkdir(f)
+        LOGGER.debug('New folder created %s', f)
+
+    except FileExistsError:
+
+        LOGGER.warning('Folder already exists %s', f)
+
+    return f
+
+
+def export_pages(attachment_id, pages, paths=None, rotated=None):
+    """
+    save pages as images to the image store directory
+    :params attachment_id: the attachment_id the pages belong to
+    :params pages: list of grayscale numpy arrays
+    :params paths: list of image files the pages were rendered to if they
+    were rendered straight to disk, only pages that have been rotated since
+    are then saved
+    :params rotated: boolean array of which pages have been rotated, needed
+    if paths is given
+    :returns: tuple of image folder, list of filepaths and list of errors.
+    If export_config['archive'] is set the pages are written to a single
+    archive (see the archive module), the image folder is then None and the
+    filepaths are references to the pages within the archive
+    """
+
+    LOGGER.debug('Received call to export_pages for attachment_id %s',
+                 attachment_id)
+
+    # empty lists for filepaths and errors
+    image_filepaths = []
+    errors = []
+
+    # write all the pages to one archive file, replacing any image files
+    # they were rendered to
+    if local_config.export_config['archive']:
+
+        fn = '%s/%s.pages' % (local_config.image_store_dir, attachment_id)
+
+        try:
+
+            LOGGER.debug('Exporting %s', fn)
+            image_filepaths = archive.write_archive(fn, pages)
+
+        except Exception as e:
+
+            LOGGER.warning('Export of %s failed - %s', fn, e)
+            return None, image_filepaths, ['image_export']
+
+        if paths is not None:
+            shutil.rmtree('%s/%s' % (local_config.image_store_dir,
+                                     attachment_id), ignore_errors=True)
+
+        return None, image_filepaths, errors
+
+    # if the pages are already on disk then only the rotated pages need to
+    # be saved again
+    if paths is not None:
+
+        f = '%s/%s' % (local_config.image_store_dir, attachment_id)
+
+        for i in range(len(pages)):
+
+            if rotated[i]:
+
+                # write to a new file then swap it in, as the original may
+                # still be memory mapped
+                try:
+
+                    LOGGER.debug('Exporting rotated %s', paths[i])
+
+                    if paths[i].endswith('.pgm'):
+                        Image.fromarray(pages[i]).save(paths[i] + '.tmp',
+                                                       format='PPM')
+                        os.replace(paths[i] + '.tmp', paths[i])
+                    else:
+                        encode.save_png(pages[i], paths[i])
+
+                except Exception as e:
+
+                    LOGGER.warning('Export of %s failed - %s', paths[i], e)
+                    errors.append('image_export')
+                    continue
+
+            image_filepaths.append(paths[i])
+
+        return f, image_filepaths, errors
+
+    # create the image folder
+    f = make_image_folder(attachment_id)
+
+    # save each page
+    for i in range(len(pages)):
+
+        # make filename
+        fn = f + '/' + str(attachment_id) + '_' + str(i + 1) + '.png'
+
+        # try to save the image to above path
+        try:
+
+            LOGGER.debug('Exporting %s', fn)
+            encode.save_png(pages[i], fn)
+            image_filepaths.append(fn)
+
+        # if there's an error record it as an error
+        except Exception as e:
+
+            LOGGER.warning('Export of %s failed - %s', fn, e)
+            errors.append('image_export')
+
+    return f, image_filepaths, errors
+
+
+def rasterise_pdf(attachment_id, path, render_threads=1):
+    """
+    convert a pdf to a list of grayscale page images, if
+    rasterise_config['disk_format'] is set the pages are rendered straight to
+    the image store directory and memory mapped (pgm) or loaded (png) from there
+    :params attachment_id: the attachment_id the file belongs to
+    :params path: location of the downloaded file
+    :params render_threads: number of poppler processes to split the pages of
+    the document across
+    :returns: tuple of list of grayscale numpy arrays, list of paths to the
+    rendered image files (None if rendered in memory) and list of errors
+    """
+
+    LOGGER.debug('Received call to rasterise_pdf for attachment_id %s',
+                 attachment_id)
+
+    c = local_config.rasterise_config
+    paths = None
+    st = time.perf_counter()
+
+    try:
+
+        # render straight to the image store
+        if c['disk_format'] is not None:
+
+            f = make_image_folder(attachment_id)
+
+            if c['targeted']:
+                paths = render.render_targeted(
+                    path, inspection_pages(), c['inspection_dpi'],
+                    c['check_dpi'], f, attachment_id, c['disk_format'],
+                    render_threads)
+            else:
+                paths = render.render_pages_to_folder(
+                    path, f, attachment_id, fmt=c['disk_format'],
+                    thread_count=render_threads)
+
+            pages = [render.load_page(x) for x in paths]
+
+        # render only the pages needed at the resolution they're needed at
+        elif c['targeted']:
+            pages = render.render_targeted(
+                path, inspection_pages(), c['inspection_dpi'],
+                c['check_dpi'], thread_count=render_threads)
+
+        # otherwise convert the whole pdf to images
+        else:
+            i = pdf2image.convert_from_path(path, thread_count=render_threads)
+
+            # convert each image to a grayscale image
+            pages = [convert_to_gray(np.array(x)) for x in i]
+
+        LOGGER.info('Image conversion successful for attachment_id %s; %s pages',
+                    attachment_id, len(pages))
+        LOGGER.debug('Rendered attachment_id %s in %.3fs; targeted %s, disk_format %s, render_threads %s',
+                     attachment_id, time.perf_counter() - st, c['targeted'],
+                     c['disk_format'], render_threads)
+
+        return pages, paths, []
+
+    except (AttributeError, pdf2image.exceptions.PDFPageCountError) as e:
+
+        LOGGER.warning('Image conversion failed for attachment_id %s - %s',
+                       attachment_id, path)
+
+        # catch normal/expected errors and log them
+        return [], None, ['image_conversion']
+
+
+def analyse_pages(attachment_id, pages):
+    """
+    identify empty pages and rotate any landscape pages
+    :params attachment_id: the attachment_id the pages belong to
+    :params pages: list of grayscale numpy arrays
+    :returns: tuple of list of (rotated) pages and analysis.PAGE_RECORD
+    array of the analysis of each page
+    """
+
+    LOGGER.debug('Received call to analyse_pages for attachment_id %s',
+                 attachment_id)
+
+    # work out spread, ink coverage and orientation of all pages at once
+    a = analysis.analyse_stack(pages, local_config.analysis_config['minsd'])
+
+    # rotate any landscape pages
+    pages = analysis.rotate_landscape_pages(pages, a['landscape'])
+
+    return pages, a
+
+
+def inspection_pages():
+    """
+    get the number of pages from the start of each document rendered at
+    inspection resolution, enough to cover rasterise_config['inspection_pages']
+    and every page a crop template takes a region from
+    :returns: number of pages
+    """
+
+    return max(local_config.rasterise_config['inspection_pages'],
+               templates.get_registry().max_page)
+
+
+def cache_key(md5):
+    """
+    get the page cache key for a file under the current settings
+    :params md5: md5 of the file
+    :returns: key string
+    """
+
+    return cache.entry_key(md5, inspection_pages())
+
+
+def get_cached_pages(md5):
+    """
+    get the pages and page analysis of a previously seen file from the page
+    cache
+    :params md5: md5 of the file
+    :returns: tuple of list of grayscale numpy arrays and
+    analysis.PAGE_RECORD array, None if the file isn't in the cache (or the
+    cache is turned off)
+    """
+
+    c = cache.get_cache()
+
+    if c is None:
+        return None
+
+    return c.get(cache_key(md5))
+
+
+def cache_pages(md5, pages, a):
+    """
+    add the pages and page analysis of a file to the page cache, if turned on
+    :params md5: md5 of the file
+    :params pages: list of grayscale numpy arrays
+    :params a: analysis.PAGE_RECORD array
+    """
+
+    c = cache.get_cache()
+
+    if c is not None:
+        c.put(cache_key(md5), pages, a)
+
+
+def crop_image(img, x, y, w, h, fw):
+    """
+    crop out a specific portion of a page image, and return it to specific
+    width and height
+    if x + w or y + h > 1 then just crops to limit of image
+    :params img: grayscale numpy array of the page, only the cropped region
+    is read so it can be memory mapped
+    :params x: top left corner to start crop as proportion of page width
+    :params y: top left corner to start crop as proportion of page width
+    :params w: proportion of page width to include in crop
+    :params h: proportion of page height to include in crop
+    :params fw: final width of image in pixels to crop to
+    :returns: crop of page to required limits
+    """
+
+    # get image sizes and resize factors
+    ih, iw = img.shape
+    f = iw / fw
+
+    # crop out the relevant part of the image
+    cimg = img[int(ih * y):int(ih * min(y + h, 1)),
+               int(iw * x):int(iw * min(x + w, 1))]
+
+    # resize the crop
+    return cv2.resize(np.asarray(cimg), dsize=(int(ih / f), fw))
+
+
+def load_stored_page(attachment_id, p, path):
+    """
+    load a page that has already been processed, from the page store if it's
+    there (memory mapped) or otherwise from the exported image, never from
+    the original file
+    :params attachment_id: the attachment_id the page belongs to
+    :params p: page number
+    :params path: the tk_db.Page.path of the page, an image file or archive
+    page reference
+    :returns: grayscale numpy array, None if the page can't be loaded
+    """
+
+    s = pagestore.get_store()
+    r = s.get_page(attachment_id, p) if s is not None else None
+
+    if r is not None:
+        return r[0]
+
+    try:
+        return archive.load_page(path)
+
+    except (OSError, ValueError, IndexError) as e:
+
+        LOGGER.warning('Unable to load page %s of attachment_id %s - %s',
+                       p, attachment_id, e)
+        return None
+
+
+def recrop_page(attachment_id, p, path, x, y, w, h, fw, folder):
+    """
+    crop a page that has already been processed and save the crop as PNG,
+    without downloading or rasterising the original file
+    :params attachment_id: the attachment_id the page belongs to
+    :params p: page number
+    :params path: the tk_db.Page.path of the page
+    :params x: top left corner to start crop as proportion of page width
+    :params y: top left corner to start crop as proportion of page width
+    :params w: proportion of page width to include in crop
+    :params h: proportion of page height to include in crop
+    :params fw: final width of image in pixels to crop to
+    :params folder: folder to save the crop to
+    :returns: path to the crop, None if the page couldn't be loaded or
+    cropped
+    """
+
+    img = load_stored_page(attachment_id, p, path)
+
+    if img is None:
+        return None
+
+    fn = '%s/%s_crop_%s.png' % (folder, attachment_id, p)
+
+    # a bad page is skipped rather than stopping the whole recrop
+    try:
+        encode.save_png(crop_image(img, x, y, w, h, fw), fn)
+    except (cv2.error, ValueError, OSError) as e:
+        LOGGER.warning('Unable to crop page %s of attachment_id %s - %s', p,
+                       attachment_id, e)
+        return None
+
+    return fn
+
+
+def page_dpis(n):
+    """
+    get the resolution each page of a document is rendered at with the
+    current rasterise_config
+    :params n: number of pages
+    :returns: list of dpi, one per page
+    """
+
+    c = local_config.rasterise_config
+
+    if not c['targeted']:
+        return [200] * n
+
+    k = inspection_pages()
+
+    return [c['inspection_dpi'] if i < k else c['check_dpi']
+            for i in range(n)]
+
+
+def store_pages(attachment_id, pages):
+    """
+    add the pages of an attachment to the page store, if it's turned on
+    :params attachment_id: the attachment_id the pages belong to
+    :params pages: list of grayscale numpy arrays
+    """
+
+    s = pagestore.get_store()
+
+    if s is None or not len(pages):
+        return
+
+    try:
+        s.put(attachment_id, pages, page_dpis(len(pages)))
+
+    # the store is only a convenience, so carry on without it
+    except OSError as e:
+        LOGGER.warning('Unable to add attachment_id %s to page store - %s',
+                       attachment_id, e)
+
+
+def render_file(attachment_id, path, render_threads=1):
+    """
+    run the rasterise, analyse and export stages for a downloaded pdf. Only
+    takes and returns plain values so can be run in a worker process
+    :params attachment_id: the attachment_id the file belongs to
+    :params path: location of the downloaded file
+    :params render_threads: number of poppler processes to split the pages of
+    the document across
+    :returns: dictionary of md5, pages, page_analysis, empty_pages,
+    image_folder, image_filepaths and errors
+    """
+
+    LOGGER.debug('Received call to render_file for attachment_id %s',
+                 attachment_id)
+
+    r = {'md5': cache.file_md5(path)}
+
+    # if we've seen the file before then reuse the pages and analysis
+    hit = get_cached_pages(r['md5'])
+
+    if hit is not None:
+
+        r['pages'], r['page_analysis'] = hit
+        paths, r['errors'] = None, []
+
+    else:
+
+        pages, paths, r['errors'] = rasterise_pdf(attachment_id, path,
+                                                  render_threads)
+        r['pages'], r['page_analysis'] = analyse_pages(attachment_id, pages)
+
+        if not r['errors']:
+            cache_pages(r['md5'], r['pages'], r['page_analysis'])
+
+    r['empty_pages'] = r['page_analysis']['empty'].tolist()
+    r['image_folder'], r['image_filepaths'], e = export_pages(
+        attachment_id, r['pages'], paths, r['page_analysis']['landscape'])
+    r['errors'].extend(e)
+
+    if not r['errors']:
+        store_pages(attachment_id, r['pages'])
+
+    return r
+
+
+def uids_from_attachment_url(url):
+    """
+    get the patient and referral uids from an attachment url, the S3 key
+    starts with the patient_uid and referral_uid split by an underscore
+    :params url: gr_db.Attachment.attachment_url (bucket/key)
+    :returns: tuple of patient_uid and referral_uid
+    """
+
+    s = url.split('/')[-1].split('_')
+
+    return s[0], s[1]
+
+
+def get_patients_info(session, patient_uids, chunk_size=1000):
+    """
+    get the name and date of birth for a batch of patients from the GR
+    database in as few queries as possible
+    :params session: a SQLAlchemy session
+    :params patient_uids: iterable of patient uids
+    :params chunk_size: number of patients to query at once
+    :returns: dictionary of patient_uid to tuple of (first name, family name,
+    date of birth)
+    """
+
+    u = uids.valid_uids(patient_uids, 'patient')
+
+    LOGGER.debug('Received call to get_patients_info for %s patients', len(u))
+
+    d = {}
+
+    for i in range(0, len(u), chunk_size):
+
+        q = session.query(gr_db.Patient.uid,
+                          gr_db.Person.person_first_name,
+                          gr_db.Person.person_family_name,
+                          gr_db.Patient.patient_date_of_birth).\
+            join(gr_db.Person,
+                 gr_db.Person.uid == gr_db.Patient.person_uid).\
+            filter(gr_db.Patient.uid.in_(u[i:i + chunk_size]))
+
+        d.update({str(x[0]): tuple(x[1:]) for x in q})
+
+    LOGGER.info('Got details of %s of %s patients', len(d), len(u))
+
+    return d
+
 
 class Attachment:
     """
     An attachment present within the GMS GR database, comprising a SQLAlchemy
     Attachment object and it's matching S3 Object
 
+    Processing of the file is split into stages, each a method that can be
+    run (and timed) separately by the pipeline module:
+    fetch > rasterise > analyse > export > persist (add_pages_to_db)
+
     Attributes:
         gr_attachment: an Instance of gr_db.Attachment
         s3_object: an S3 Object
@@ -32,6 +544,8 @@ class Attachment:
         scans
         empty_pages: boolean list showing which of the pages is thought to be
         empty
+        page_analysis: analysis.PAGE_RECORD array with the pixel spread, ink
+        coverage, orientation and emptiness of each page
         errored: boolean to record if there were errors during processing
         errors: list of errors that have accumalated over the course of
         document processing
@@ -39,302 +553,412 @@ class Attachment:
         page of the document
         image_filepaths: list of file paths to the png images for each page of
         the document
+        render_paths: list of file paths the pages were rendered to if they
+        were rendered straight to disk, otherwise None
+        md5: md5 of the downloaded file, used as the key for the page cache
+        cache_hit: whether the pages and analysis came from the page cache
         person_name: the name of the patient as given in the GR database
         dob: the date of birth of the patient as given in the GR database
+        render_threads: number of poppler processes to split the pages of the
+        document across when rasterising
     """
 
-    def __init__(self, gr_attachment, session):
+    def __init__(self, gr_attachment, session, process=True,
+                 render_threads=1, writer=None):
+        """
+        create a new instance of Attachment
+        :params gr_attachment: an instance of gr_db.Attachment
+        :params session: a SQLAlchemy session
+        :params process: whether to run the fetch, rasterise, analyse and
+        export stages straight away, if False they are left to the caller
+        (see the pipeline and pool modules)
+        :params render_threads: number of poppler processes to split the
+        pages of the document across when rasterising
+        :params writer: optional bulk.BulkWriter to add the tk_db.Attachment
+        row to, rather than adding it to the session
+        """
 
-        def log_error(e):
-            """
-            log an error and make the attachment 'errored'
-            """
+        # create the attributes
+        self.errors = []
+        self.errored = False
+        self.gr_attachment = gr_attachment
+        self.render_threads = render_threads
+        self.s3_object = self.create_s3_object()
+        self.tk_db_attachment = self.add_to_db(session, writer)
+        self.attachment_id = self.tk_db_attachment.uid
+        self.pages = []
+        self.empty_pages = []
+        self.page_analysis = analysis.analyse_stack([])
+        self.image_folder = None
+        self.image_filepaths = []
+        self.render_paths = None
+        self.md5 = None
+        self.cache_hit = False
+        self.person_name = None
+        self.dob = None
 
-            LOGGER.debug('Error during processing of %s - %s',
-                         self.gr_attachment.attachment_url, e)
-            self.errored = True
-            self.errors.append(e)
+        # do processing of file - download, convert to image, export
+        if process:
+            self.fetch()
+            self.rasterise()
+            self.analyse()
+            self.export()
 
-        def create_s3_object():
-            """
-            create S3 object from the filepath
-            """
+        # match to patient and referral
+        self.extract_uids_from_attachment_path()
 
-            LOGGER.debug('Received call to create_s3_object')
+    def log_error(self, e):
+        """
+        log an error and make the attachment 'errored'
+        :params e: description of the error
+        """
 
-            try:
+        LOGGER.debug('Error during processing of %s - %s',
+                     self.gr_attachment.attachment_url, e)
+        self.errored = True
+        self.errors.append(e)
 
-                f = self.gr_attachment.attachment_url
-                b, k = f.split('/')
+    def create_s3_object(self):
+        """
+        create S3 object from the filepath
+        :returns: S3 Object, None if the file is held inline in the GR
+        database instead
+        """
+
+        LOGGER.debug('Received call to create_s3_object')
 
-                return s3.create_s3_obj(b, k)
+        # no url means the file is held inline as attachment_data
+        if self.gr_attachment.attachment_url is None:
+            return None
 
-            except Exception as e:
+        try:
 
-                log_error('sourcing file from s3 - %s' % e)
+            f = self.gr_attachment.attachment_url
+            b, k = f.split('/')
 
-        def add_to_db():
-            """
-            add the attachment to the tracker db
-            :returns: tk_db.Attachment object flushed through db
-            """
+            return s3.create_s3_obj(b, k)
 
-            # create the SQLAlchemy object
-            a = tk_db.Attachment(
-                uid=gr_attachment.uid,
-                s3_bucket=self.s3_object.bucket_name,
-                s3_key=self.s3_object.key,
-                pages=[],
-                errors=[]
-            )
+        except Exception as e:
 
-            # add then flush
+            self.log_error('sourcing file from s3 - %s' % e)
+
+    def add_to_db(self, session, writer=None):
+        """
+        add the attachment to the tracker db, it is identified by the GR uid
+        so there's no need to flush to get an id
+        :params session: a SQLAlchemy session
+        :params writer: optional bulk.BulkWriter to add the row to, it is
+        then written with the rest of the batch
+        :returns: tk_db.Attachment object
+        """
+
+        # create the SQLAlchemy object
+        a = tk_db.Attachment(
+            uid=self.gr_attachment.uid,
+            s3_bucket=getattr(self.s3_object, 'bucket_name', None),
+            s3_key=getattr(self.s3_object, 'key', None),
+            pages=[],
+            errors=[]
+        )
+
+        # either leave it to the bulk writer or add it to the session
+        if writer is not None:
+            writer.add_object(a, ['uid', 's3_bucket', 's3_key', 'md5',
+                                  'patient_uid', 'referral_uid', 'ticket_id'])
+        else:
             session.add(a)
-            session.flush()
 
-            return a
+        return a
 
-        def check_mime_type():
-            """
-            get file mime type for the current attachment
-            """
+    def extract_uids_from_attachment_path(self):
+        """
+        extract the patient and referral uids from filename
+        """
 
-            LOGGER.debug('Received call to check_mime_type for attachment_id %s',
-                         self.attachment_id)
+        LOGGER.debug('Received call to extract_uids_from_attachment_path\
+                     for attachment_id %s', self.attachment_id)
 
-            return mimetypes.guess_type(self.path)
+        # inline files don't have a filename to go on
+        if self.s3_object is None:
 
-        def convert_to_gray(i):
-            """
-            convert image as np array to grayscale
-            :params i: numpy array of image
-            :returns: grayscale image
-            """
+            LOGGER.warning('No S3 key to extract uids from for attachment_id %s',
+                           self.attachment_id)
+            return
 
-            LOGGER.debug('Received call to convert_to_gray for attachment_id %s',
-                         self.attachment_id)
+        # patient_uid and referral_uid split by an underscore
+        self.tk_db_attachment.patient_uid, \
+            self.tk_db_attachment.referral_uid = \
+            uids_from_attachment_url(self.s3_object.key)
 
-            return cv2.cvtColor(i, cv2.COLOR_BGR2GRAY)
+    def fetch(self):
+        """
+        fetch stage - download file from S3 to temp, or if there's no S3 url
+        write out the file held inline in the GR database
+        """
 
-        def identify_empty_pages(minsd=10):
-            """
-            identify pages that are likely empty
-            :params minsd: cut-off standard deviation for pixel values to be
-            considered empty
-            """
+        LOGGER.debug('Received call to fetch for attachment_id %s',
+                     self.attachment_id)
 
-            LOGGER.debug('Received call to identify_empty_pages for attachment_id %s',
-                         self.attachment_id)
+        # create a temporary file to download to
+        f = tempfile.NamedTemporaryFile(delete=False)
 
-            # generates a boolean list for whether the page is empty or not
-            self.empty_pages = [np.std(i) < minsd for i in self.pages]
+        # try to download the s3 object to the temporary file
+        try:
 
-        def rotate_landscape_pages():
-            """
-            rotate any landscape pages
-            """
+            if self.s3_object is None:
+                self.fetch_inline(f)
+            else:
+                self.s3_object.download_fileobj(f)
+                self.apply_download(f.name)
 
-            LOGGER.debug('Received call to rotate_landscape_pages for attachment_id %s',
-                         self.attachment_id)
+        # if we encounter an error log it
+        except ClientError as e:
 
-            # process each page that is wider that it is tall
-            for i in range(len(self.pages)):
+            self.apply_download(None)
 
-                if self.pages[i].shape[1] > self.pages[i].shape[0]:
+        finally:
 
-                    LOGGER.debug('Rotating page number %s', (i+1))
+            f.close()
 
-                    self.pages[i] = np.rot90(self.pages[i])
-        
-        def process_pdf_to_image():
-            """
-            get grayscale images from pdf files, identify empties and rotate
-            any landscape pages
-            """
+    def fetch_inline(self, f):
+        """
+        write the file held inline in the GR database to a file, the
+        discovery query defers attachment_data so rather than loading it
+        whole it is read a chunk at a time with a substring query for each
+        :params f: file object to write to
+        """
 
-            LOGGER.debug('Received call to process_pdf_to_image for attachment_id %s',
-                         self.attachment_id)
+        LOGGER.debug('Received call to fetch_inline for attachment_id %s',
+                     self.attachment_id)
 
-            try:
+        # if it's been loaded already there's nothing to gain by streaming
+        if 'attachment_data' in self.gr_attachment.__dict__:
 
-                # convert pdf to images
-                i = pdf2image.convert_from_path(self.path)
+            if self.gr_attachment.attachment_data is None:
+                self.apply_download(None)
+                return
 
-                # convert each image to a grayscale image
-                self.pages = [convert_to_gray(np.array(x)) for x in i]
+            f.write(self.gr_attachment.attachment_data)
 
-                # identify empty pages
-                identify_empty_pages()
+        else:
 
-                # rotate any landscape pages
-                rotate_landscape_pages()
+            s = object_session(self.gr_attachment)
+            c = gr_db.Attachment.attachment_data
+            w = gr_db.Attachment.uid == self.gr_attachment.uid
 
-                LOGGER.info('Image conversion successful for attachment_id %s; %s pages',
-                            self.attachment_id, len(self.pages))
+            n = s.query(func.length(c)).filter(w).scalar()
 
-            except (AttributeError, pdf2image.exceptions.PDFPageCountError) as e:
+            if n is None:
+                self.apply_download(None)
+                return
 
-                LOGGER.warning('Image conversion failed for attachment_id %s - %s',
-                               self.attachment_id, self.path)
+            # substring positions start at 1
+            for i in range(0, n, INLINE_CHUNK):
+                f.write(s.query(func.substring(c, i + 1, INLINE_CHUNK)).
+                        filter(w).scalar())
 
-                # catch normal/expected errors and log them
-                log_error('image_conversion')
+        f.flush()
+        self.apply_download(f.name)
 
-        def delete_temp_file():
-            """
-            deletes the tempfile where the s3 object was downloaded to and it's reference
-            """
+    def apply_download(self, path):
+        """
+        record the result of downloading the file from S3
+        :params path: location the file was downloaded to, None if the
+        download failed
+        """
 
-            LOGGER.debug('Received call to delete_temp_file for attachment_id %s - %s',
-                         self.attachment_id, self.path)
+        # if there's no path then the download failed
+        if path is None:
 
-            os.remove(self.path)
+            LOGGER.warning('Failed to download attachment_id %s - %s',
+                           self.attachment_id,
+                           self.gr_attachment.attachment_url)
+            self.log_error('download')
 
-            del self.path
+        else:
 
-        def export_pages():
-            """
-            save pages as images to the image store directory
-            """
+            self.path = path
+            self.mime_type = mimetypes.guess_type(self.path)[0]
 
-            LOGGER.debug('Received call to export_pages for attachment_id %s',
-                         self.attachment_id)
+    def rasterise(self):
+        """
+        rasterise stage - convert the downloaded pdf to grayscale images, or
+        get them from the page cache if the same file has been seen before
+        """
 
-            # create the image folder path and empty list for filepaths
-            f = '%s/%s' % (local_config.image_store_dir, self.attachment_id)
-            self.image_folder = f
-            self.image_filepaths = []
+        # only attempt if we've got a file path
+        if hasattr(self, 'path'):
 
-            # try to create the folder, carry on if folder already exists
-            try:
+            self.md5 = cache.file_md5(self.path)
+            self.tk_db_attachment.md5 = self.md5
 
-                os.mkdir(f)
-                LOGGER.debug('New folder created %s', f)
+            hit = get_cached_pages(self.md5)
 
-            except FileExistsError:
+            if hit is not None:
+                self.pages, self.page_analysis = hit
+                self.empty_pages = self.page_analysis['empty'].tolist()
+                self.cache_hit = True
+                return
 
-                LOGGER.warning('Folder already exists %s', f)
+            self.pages, self.render_paths, e = rasterise_pdf(
+                self.attachment_id, self.path, self.render_threads)
 
-            # save each page
-            for i in range(len(self.pages)):
+            for i in e:
+                self.log_error(i)
 
-                # make filename
-                fn = f + '/' + str(self.attachment_id) + '_' + str(i + 1) + '.png'
+    def analyse(self):
+        """
+        analyse stage - identify empty pages and rotate any landscape pages,
+        the results are added to the page cache
+        """
 
-                # try to save the image to above path
-                try:
+        # pages from the cache have already been analysed
+        if self.cache_hit:
+            return
 
-                    LOGGER.debug('Exporting %s', fn)
-                    Image.fromarray(self.pages[i]).save(fn)
-                    self.image_filepaths.append(fn)
+        self.pages, self.page_analysis = analyse_pages(self.attachment_id,
+                                                       self.pages)
+        self.empty_pages = self.page_analysis['empty'].tolist()
 
-                # if there's an error as it as an erro
-                except Exception as e:
+        if self.md5 is not None and not self.errored:
+            cache_pages(self.md5, self.pages, self.page_analysis)
 
-                    LOGGER.warning('Export of %s failed - %s', fn, e)
-                    log_error('image_export')
+    def export(self):
+        """
+        export stage - save pages to the image store and tidy up the download
+        """
 
-        def process_file():
-            """
-            download file from S3 to temp and convert to image
-            """
+        # only attempt if we've got a file path
+        if hasattr(self, 'path'):
 
-            LOGGER.debug('Received call to process_file for attachment_id %s',
-                         self.attachment_id)
+            self.image_folder, self.image_filepaths, e = export_pages(
+                self.attachment_id, self.pages, self.render_paths,
+                self.page_analysis['landscape'])
 
-            # create a temporary file to download to
-            f = tempfile.NamedTemporaryFile(delete=False)
+            for i in e:
+                self.log_error(i)
 
-            # try to download the s3 object to the temporary file
-            try:
+            # if we didn't pick up any errors then keep the raw pages and
+            # delete the file
+            if not self.errored:
+                store_pages(self.attachment_id, self.pages)
+                self.delete_temp_file()
 
-                self.s3_object.download_fileobj(f)
-                self.path = f.name
-                self.mime_type = check_mime_type()[0]
+    def apply_render(self, r):
+        """
+        update the attributes with the output of render_file, used in place
+        of the rasterise, analyse and export stages when they are run in a
+        worker process
+        :params r: dictionary returned by render_file
+        """
 
-            # if we encounter an error log it
-            except ClientError as e:
+        LOGGER.debug('Received call to apply_render for attachment_id %s',
+                     self.attachment_id)
 
-                LOGGER.warning('Failed to download attachment_id %s - %s',
-                               self.attachment_id, self.s3_object.key)
-                log_error('download')
+        self.md5 = r['md5']
+        self.tk_db_attachment.md5 = self.md5
+        self.pages = r['pages']
+        self.page_analysis = r['page_analysis']
+        self.empty_pages = r['empty_pages']
+        self.image_folder = r['image_folder']
+        self.image_filepaths = r['image_filepaths']
 
-            # if we've got a file path then attempt to convert to images and export
-            if hasattr(self, 'path'):
-                process_pdf_to_image()
-                export_pages()
+        for e in r['errors']:
+            self.log_error(e)
 
-            # if we didn't pick up any errors then can delete the file
-            if not self.errored:
-                delete_temp_file()
+    def delete_temp_file(self):
+        """
+        deletes the tempfile where the s3 object was downloaded to and it's reference
+        """
 
-        def extract_uids_from_attachment_path():
-            """
-            extract the patient and referral uids from filename
-            """
+        LOGGER.debug('Received call to delete_temp_file for attachment_id %s - %s',
+                     self.attachment_id, self.path)
 
-            LOGGER.debug('Received call to extract_uids_from_attachment_path\
-                         for attachment_id %s', self.attachment_id)
+        os.remove(self.path)
 
-            # patient_uid and referral_uid split by an underscore
-            s = self.s3_object.key.split('_')
-            self.tk_db_attachment.patient_uid = s[0]
-            self.tk_db_attachment.referral_uid = s[1]
+        del self.path
 
-        # create the attributes
-        self.errors = []
-        self.errored = False
-        self.gr_attachment = gr_attachment
-        self.s3_object = create_s3_object()
-        self.tk_db_attachment = add_to_db()
-        self.attachment_id = self.tk_db_attachment.attachment_id
-        self.pages = []
-        self.person_name = None
-        self.dob = None
+    def release_pages(self):
+        """
+        drop the page arrays once they're no longer needed, keeps memory flat
+        when working through a large number of attachments
+        """
 
-        # do processing of file - download, convert to image, export
-        process_file()
+        LOGGER.debug('Received call to release_pages for attachment_id %s',
+                     self.attachment_id)
 
-        # match to patient and referral
-        extract_uids_from_attachment_path()
+        self.pages = []
 
-    def add_pages_to_db(self):
+    def add_pages_to_db(self, writer=None):
         """
-        add relevant rows to page table of database
+        persist stage - add relevant rows to page table of database, needs to
+        be called before release_pages
+        :params writer: optional bulk.BulkWriter to add the rows to, rather
+        than adding them to the session one at a time
         """
 
+        if writer is not None:
+
+            for i in range(len(self.pages)):
+                writer.add(tk_db.Page,
+                           attachment_uid=self.tk_db_attachment.uid,
+                           path=self.image_filepaths[i],
+                           page_number=i + 1,
+                           page_empty=self.empty_pages[i])
+
+            return
+
         for i in range(len(self.pages)):
-            self.tk_db_attachment.images.append(tk_db.Page(
+            self.tk_db_attachment.pages.append(tk_db.Page(
                 path=self.image_filepaths[i],
                 page_number=i + 1,
                 page_empty=self.empty_pages[i]
             ))
 
-    def get_patient_info(self, session):
+    def get_patient_info(self, session, patients=None):
         """
         get patient info from GR database for the form's owner
+        :params session: a SQLAlchemy session
+        :params patients: optional dictionary from get_patients_info for a
+        batch of attachments, if given it is read from rather than querying
+        the GR database for this attachment alone
         """
 
         LOGGER.debug('Received call to get_patient_info for attachment_id %s; patient_uid %s',
                      self.attachment_id, self.tk_db_attachment.patient_uid)
 
-        q = session.query(gr_db.Person.person_first_name,
-                          gr_db.Person.person_family_name,
-                          gr_db.Patient.patient_date_of_birth).\
-            join(gr_db.Person,
-                 gr_db.Person.uid == gr_db.Patient.person_uid).\
-            filter(gr_db.Patient.uid == self.tk_db_attachment.patient_uid).\
-            first()
+        # inline files have no S3 key to get a patient uid from, so there's
+        # no participant to link to
+        if self.tk_db_attachment.patient_uid is None:
+
+            LOGGER.warning('No patient uid to link %s to a participant',
+                           self.attachment_id)
+            self.log_error('no patient uid to link to participant')
+            return
+
+        if patients is not None:
+
+            q = patients.get(str(self.tk_db_attachment.patient_uid))
+
+        else:
+
+            q = session.query(gr_db.Person.person_first_name,
+                              gr_db.Person.person_family_name,
+                              gr_db.Patient.patient_date_of_birth).\
+                join(gr_db.Person,
+                     gr_db.Person.uid == gr_db.Patient.person_uid).\
+                filter(gr_db.Patient.uid == self.tk_db_attachment.patient_uid).\
+                first()
 
         # if we've got values for fore and surname and dob, then process
-        if all(x is not None for x in q):
+        if q is not None and all(x is not None for x in q):
             self.person_name = f'{q[0]} {q[1]}'.upper()
             self.dob = '{0:%Y-%m-%d}'.format(q[2])
 
         else:
 
             LOGGER.warning('Unable to link %s to valid participant', self.attachment_id)
-            self.errors.append('linking to participant')
+            self.log_error('linking to participant')
 
     def crop_page(self, p, x, y, w, h, fw):
         """
@@ -350,25 +974,75 @@ class Attachment:
         :returns: crop of page to required limits
         """
 
-        assert( 1 <= p <= len(self.pages),
-               'page number requested outside of range for attachment')
-        assert(all([0 <= x <= 1 for x in [x, y, w, h]]),
-               'x, y, w, and h must all be in 0-1 range')
+        assert 1 <= p <= len(self.pages), \
+            'page number requested outside of range for attachment'
+        assert all([0 <= x <= 1 for x in [x, y, w, h]]), \
+            'x, y, w, and h must all be in 0-1 range'
 
         LOGGER.debug('Received call to crop_page for attachment_id %s',
                      self.attachment_id)
 
-        # get image sizes and resize factors
-        img = self.pages[p - 1]
-        ih, iw = img.shape
-        f = iw / fw
+        # if the same crop of the same file has been made before reuse it
+        c = cache.get_cache() if self.md5 is not None else None
+        k = 'crop_%s_%s_%s_%s_%s_%s' % (p, x, y, w, h, fw)
+
+        if c is not None:
+            cimg = c.get_array(cache_key(self.md5), k)
+            if cimg is not None:
+                return cimg
 
         # crop out the relevant part of the image
-        cimg = img[int(ih * y):int(ih * min(y + h, 1)),
-                   int(iw * x):int(iw * min(x + w, 1))]
+        cimg = crop_image(self.pages[p - 1], x, y, w, h, fw)
+
+        if c is not None:
+            c.put_array(cache_key(self.md5), k, cimg)
+
+        return cimg
+
+    def crop_png(self, p, x, y, w, h, fw, name=None):
+        """
+        crop out a specific portion of a page (as crop_page) encoded as PNG.
+        The crop is only encoded once, the same bytes are saved alongside the
+        page images and returned for upload, and kept in the page cache
+        :params p: page number
+        :params x: top left corner to start crop as proportion of page width
+        :params y: top left corner to start crop as proportion of page width
+        :params w: proportion of page width to include in crop
+        :params h: proportion of page height to include in crop
+        :params fw: final width of image in pixels to crop to
+        :params name: optional name of the region, used in the filename of the
+        copy saved alongside the page images
+        :returns: Bytes object with PNG format
+        """
+
+        LOGGER.debug('Received call to crop_png for attachment_id %s',
+                     self.attachment_id)
+
+        # if the same crop of the same file has been encoded before reuse it
+        c = cache.get_cache() if self.md5 is not None else None
+        k = 'crop_%s_%s_%s_%s_%s_%s_png_%s' % (
+            p, x, y, w, h, fw, cache.settings_digest(local_config.png_config))
+
+        b = c.get_array(cache_key(self.md5), k) \
+            if c is not None else None
+
+        if b is not None:
+            b = b.tobytes()
+
+        else:
+            b = encode.encode_png(self.crop_page(p, x, y, w, h, fw))
+
+            if c is not None:
+                c.put_array(cache_key(self.md5), k,
+                            np.frombuffer(b, dtype=np.uint8))
+
+        # keep a copy with the page images
+        if self.image_folder is not None:
+            encode.write_bytes(b, '%s/%s_%s.png' % (
+                self.image_folder, self.attachment_id,
+                name or 'crop_%s' % p))
 
-        # return a resized version of the crop
-        return cv2.resize(cimg, dsize=(int(ih / f), fw))
+        return b
 
     # GOT TO HERE
     def create_fault_ticket_url(self):
@@ -384,7 +1058,7 @@ class Attachment:
             "issuetype": "3",
             "assignee": "sthompson",
             "summary": 'Consent Form Fault for File %s' % self.attachment_id,
-            "description": "Something has gone wrong with this file.\n Original location %s/%s" % (self.s3_object.bucket_name, self.s3_object.key),
+            "description": "Something has gone wrong with this file.\n Original location %s" % (self.gr_attachment.attachment_url or 'GR attachment %s' % self.gr_attachment.uid),
             "pid": "11438"
         }
 
@@ -0,0 +1,80 @@
+"""
+provides a writer that collects tracker db rows for a whole batch and writes
+each table with a single executemany, rather than adding an ORM object (and
+flushing) per row
+"""
+import collections
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BulkWriter:
+    """
+    Collects rows for tracker db tables and writes them in bulk
+
+    Primary keys are left for the database to generate. Values that aren't
+    known until the session is flushed (e.g. the ticket_id of a new
+    tk_db.Ticket) can be given as a function that is called at write time
+
+    Attributes:
+        rows: dictionary of SQLAlchemy model to list of row dictionaries
+    """
+
+    def __init__(self):
+
+        LOGGER.debug('Creating new instance of BulkWriter')
+
+        self.rows = collections.OrderedDict()
+
+    def add(self, model, **values):
+        """
+        add a row to be written
+        :params model: SQLAlchemy model of the table, e.g. tk_db.Page
+        :params values: column values for the row, callables are resolved at
+        write time
+        """
+
+        self.rows.setdefault(model, []).append(values)
+
+    def add_object(self, obj, columns):
+        """
+        add a row taking its values from a (transient) SQLAlchemy object at
+        write time, so attributes set on the object after this call are still
+        written
+        :params obj: SQLAlchemy object, which mustn't be added to the session
+        :params columns: list of column names to write
+        """
+
+        self.add(type(obj), **{c: (lambda c=c: getattr(obj, c))
+                               for c in columns})
+
+    def write(self, session):
+        """
+        flush the session (so any rows referred to exist) then write all the
+        collected rows, one executemany per table in foreign key dependency
+        order
+        :params session: SQLAlchemy session bound to the tracker db
+        """
+
+        LOGGER.debug('Received call to write')
+
+        session.flush()
+
+        for model, rows in sorted(
+                self.rows.items(),
+                key=lambda x: x[0].metadata.sorted_tables.index(x[0].__table__)):
+
+            if not len(rows):
+                continue
+
+            # resolve any values that weren't known until the flush
+            rows = [{k: v() if callable(v) else v for k, v in r.items()}
+                    for r in rows]
+
+            session.execute(model.__table__.insert(), rows)
+
+            LOGGER.info('Bulk inserted %s rows into %s', len(rows),
+                        model.__tablename__)
+
+        self.rows.clear()
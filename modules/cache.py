@@ -0,0 +1,283 @@
+"""
+provides a local content-addressed cache of rendered pages and page analysis,
+keyed by the md5 of the attachment file and a digest of the settings the
+pages were rendered and analysed with, so the same pdf uploaded against
+several referrals is only rasterised once, but never reused once the settings
+change. Entries are evicted least recently used first once the cache goes
+over its size limit
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import local_config
+
+LOGGER = logging.getLogger(__name__)
+
+
+def file_md5(path):
+    """
+    get the md5 of a file, reading it in chunks
+    :params path: location of the file
+    :returns: hex digest string
+    """
+
+    LOGGER.debug('Received call to file_md5 for %s', path)
+
+    h = hashlib.md5()
+
+    with open(path, 'rb') as f:
+        for b in iter(lambda: f.read(1 << 20), b''):
+            h.update(b)
+
+    return h.hexdigest()
+
+
+def settings_digest(*settings):
+    """
+    get a short digest of some configuration dictionaries
+    :params settings: dictionaries of settings
+    :returns: hex digest string
+    """
+
+    s = json.dumps(settings, sort_keys=True, default=str)
+
+    return hashlib.md5(s.encode()).hexdigest()[:12]
+
+
+def entry_key(md5, *settings):
+    """
+    get the cache key for a file, the md5 of the file with a digest of the
+    current rasterise_config and analysis_config
+    :params md5: md5 of the attachment file
+    :params settings: any other settings the pages depend on
+    :returns: key string
+    """
+
+    return '%s-%s' % (md5, settings_digest(local_config.rasterise_config,
+                                           local_config.analysis_config,
+                                           *settings))
+
+
+class PageCache:
+    """
+    A cache of rendered pages and page analysis on the local filesystem, each
+    entry is a folder named by its key (see entry_key) holding a .npy file
+    per page (loaded memory mapped), the page analysis and any other named
+    arrays (e.g. crops)
+
+    Attributes:
+        root: the folder holding the cache entries
+        max_bytes: the total size the cache is allowed to grow to
+        index: dictionary of key to [size in bytes, last used time] for each
+        entry
+    """
+
+    def __init__(self, root, max_bytes):
+        """
+        create a new instance of PageCache, indexing any existing entries
+        :params root: the folder holding the cache entries
+        :params max_bytes: the total size the cache is allowed to grow to
+        """
+
+        LOGGER.debug('Creating new instance of PageCache in %s', root)
+
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index = {}
+
+        os.makedirs(root, exist_ok=True)
+
+        # index the entries already in the cache
+        for k in os.listdir(root):
+            if not k.startswith('.'):
+                self.index_entry(k)
+
+        LOGGER.info('Page cache has %s entries, %s bytes',
+                    len(self.index), self.total_bytes())
+
+    def entry_path(self, md5):
+        """
+        get the folder for a cache entry
+        :params md5: cache key of the attachment file (see entry_key)
+        :returns: path to the folder
+        """
+
+        return '%s/%s' % (self.root, md5)
+
+    def index_entry(self, md5):
+        """
+        add or refresh an entry in the index from the filesystem
+        :params md5: cache key of the attachment file (see entry_key)
+        """
+
+        f = self.entry_path(md5)
+
+        try:
+            self.index[md5] = [
+                sum(x.stat().st_size for x in os.scandir(f)),
+                os.stat(f).st_mtime]
+
+        # entry may have been evicted by another process
+        except FileNotFoundError:
+            self.index.pop(md5, None)
+
+    def total_bytes(self):
+        """
+        :returns: total size of the entries in the cache
+        """
+
+        return sum(x[0] for x in self.index.values())
+
+    def get(self, md5):
+        """
+        get the pages and page analysis for a file
+        :params md5: cache key of the attachment file (see entry_key)
+        :returns: tuple of list of grayscale numpy arrays and
+        analysis.PAGE_RECORD array, None if not in the cache
+        """
+
+        LOGGER.debug('Received call to get for %s', md5)
+
+        f = self.entry_path(md5)
+
+        try:
+
+            a = np.load('%s/analysis.npy' % f)
+            pages = [np.load('%s/page_%s.npy' % (f, i + 1), mmap_mode='r')
+                     for i in range(len(a))]
+
+            # mark the entry as recently used
+            os.utime(f)
+
+        except (FileNotFoundError, ValueError):
+
+            LOGGER.debug('Cache miss for %s', md5)
+            return None
+
+        LOGGER.debug('Cache hit for %s', md5)
+        self.index_entry(md5)
+
+        return pages, a
+
+    def put(self, md5, pages, a):
+        """
+        add the pages and page analysis for a file to the cache, then evict
+        entries if the cache has grown too big
+        :params md5: cache key of the attachment file (see entry_key)
+        :params pages: list of grayscale numpy arrays
+        :params a: analysis.PAGE_RECORD array
+        """
+
+        LOGGER.debug('Received call to put for %s', md5)
+
+        f = self.entry_path(md5)
+
+        if os.path.exists(f):
+            return
+
+        # write to a temporary folder and move it into place, so other
+        # processes never see a partial entry
+        t = '%s/.tmp-%s-%s' % (self.root, md5, os.getpid())
+        os.makedirs(t, exist_ok=True)
+
+        for i in range(len(pages)):
+            np.save('%s/page_%s.npy' % (t, i + 1), np.asarray(pages[i]))
+        np.save('%s/analysis.npy' % t, a)
+
+        try:
+            os.rename(t, f)
+
+        # another process got there first
+        except OSError:
+            shutil.rmtree(t, ignore_errors=True)
+
+        self.index_entry(md5)
+        self.evict(keep=md5)
+
+    def get_array(self, md5, name):
+        """
+        get a named array (e.g. a crop) stored against a file
+        :params md5: cache key of the attachment file (see entry_key)
+        :params name: name of the array
+        :returns: numpy array, None if not in the cache
+        """
+
+        try:
+            return np.load('%s/%s.npy' % (self.entry_path(md5), name))
+
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put_array(self, md5, name, arr):
+        """
+        store a named array (e.g. a crop) against a file, only stored if the
+        file already has an entry
+        :params md5: cache key of the attachment file (see entry_key)
+        :params name: name of the array
+        :params arr: numpy array
+        """
+
+        f = self.entry_path(md5)
+
+        if not os.path.exists(f):
+            return
+
+        # np.save adds .npy to any filename without it
+        t = '%s/%s.tmp-%s.npy' % (f, name, os.getpid())
+
+        try:
+            np.save(t, arr)
+            os.replace(t, '%s/%s.npy' % (f, name))
+
+        except FileNotFoundError:
+            return
+
+        self.index_entry(md5)
+
+    def evict(self, keep=None):
+        """
+        remove the least recently used entries until the cache is within its
+        size limit
+        :params keep: md5 of an entry that shouldn't be evicted
+        """
+
+        total = self.total_bytes()
+
+        for k in sorted(self.index, key=lambda x: self.index[x][1]):
+
+            if total <= self.max_bytes:
+                break
+
+            if k == keep:
+                continue
+
+            LOGGER.debug('Evicting %s from page cache', k)
+
+            total -= self.index.pop(k)[0]
+            shutil.rmtree(self.entry_path(k), ignore_errors=True)
+
+
+# the cache for this process, created on first use
+page_cache = None
+
+
+def get_cache():
+    """
+    get the page cache for this process, as configured by
+    local_config.cache_config
+    :returns: PageCache, None if the cache is turned off
+    """
+
+    global page_cache
+
+    if local_config.cache_config['dir'] is None:
+        return None
+
+    if page_cache is None:
+        page_cache = PageCache(local_config.cache_config['dir'],
+                               local_config.cache_config['max_bytes'])
+
+    return page_cache
@@ -0,0 +1,94 @@
+"""
+provides the PNG encoding used for both page exports and the crops uploaded
+to JIRA, with a configurable compression level and optional reduction of the
+grayscale scans to 1-bit or a small palette, which makes much smaller files
+that are quicker to compress
+"""
+import io
+import logging
+import os
+import numpy as np
+from PIL import Image
+import local_config
+
+LOGGER = logging.getLogger(__name__)
+
+
+def to_image(arr, mode=None):
+    """
+    convert a grayscale numpy array to a PIL Image ready for encoding
+    :params arr: grayscale numpy array
+    :params mode: None to keep 8-bit grayscale, '1' for 1-bit (pixels below
+    png_config['threshold'] are black) or 'P' for a palette of
+    png_config['colors'] gray levels
+    :returns: PIL Image
+    """
+
+    c = local_config.png_config
+
+    if mode == '1':
+        return Image.fromarray(np.asarray(arr) >= c['threshold'])
+
+    i = Image.fromarray(np.asarray(arr))
+
+    if mode == 'P':
+        return i.quantize(colors=c['colors'])
+
+    return i
+
+
+def encode_png(arr, level=None, mode=None):
+    """
+    encode a grayscale numpy array as PNG
+    :params arr: grayscale numpy array
+    :params level: zlib compression level 0-9, defaults to
+    png_config['compress_level']
+    :params mode: None, '1' or 'P' as to_image, defaults to
+    png_config['mode']
+    :returns: Bytes object with PNG format
+    """
+
+    c = local_config.png_config
+
+    if level is None:
+        level = c['compress_level']
+
+    if mode is None:
+        mode = c['mode']
+
+    b = io.BytesIO()
+    to_image(arr, mode).save(b, format='PNG', compress_level=level)
+
+    return b.getvalue()
+
+
+def write_bytes(b, fn):
+    """
+    write encoded image bytes to a file, through a temporary file so a
+    partial image is never left in place
+    :params b: Bytes object of the image
+    :params fn: path of the file to write
+    """
+
+    LOGGER.debug('Writing %s bytes to %s', len(b), fn)
+
+    with open(fn + '.tmp', 'wb') as f:
+        f.write(b)
+
+    os.replace(fn + '.tmp', fn)
+
+
+def save_png(arr, fn, level=None, mode=None):
+    """
+    encode a grayscale numpy array as PNG and save it
+    :params arr: grayscale numpy array
+    :params fn: path of the file to write
+    :params level: zlib compression level, as encode_png
+    :params mode: None, '1' or 'P', as encode_png
+    :returns: Bytes object with PNG format, so it can be reused
+    """
+
+    b = encode_png(arr, level, mode)
+    write_bytes(b, fn)
+
+    return b
@@ -3,14 +3,16 @@ provides two different JIRA Ticket Classes built off the parent
 Ticket class
 """
 # provides two different JIRA Ticket classes
+import collections
+import concurrent.futures
 import logging
 import sys
 import datetime
-import io
+import time
 import requests
-from PIL import Image
-from local_config import jira_config
+from local_config import jira_config, jira_upload_config
 from models import tk_db
+from modules import encode, tickets
 
 
 LOGGER = logging.getLogger(__name__)
@@ -58,16 +60,61 @@ def upload_attachment(k, n, i):
     :params i: Numpy array of the image
     """
 
+    # convert the Numpy array to a Bytes object and upload it
+    post_attachment(k, n, array_to_png(i))
+
+
+def upload_attachments(k, attachments, workers=4):
+    """
+    Upload several numpy arrays to a jira ticket as pngs concurrently, the
+    PNG encoding of the next images is done in this thread while earlier ones
+    are uploading, with at most twice as many encoded images as workers held
+    at once
+    :params k: JIRA ticket key
+    :params attachments: list of tuples of (filename, numpy array), images
+    already encoded (e.g. by Attachment.crop_png) can be given as bytes
+    :params workers: maximum number of uploads in flight at once
+    """
+
+    LOGGER.debug('Received call to upload_attachments for %s images to %s',
+                 len(attachments), k)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+
+        pending = collections.deque()
+
+        for n, i in attachments:
+
+            b = i if isinstance(i, bytes) else array_to_png(i)
+            pending.append(ex.submit(post_attachment, k, n, b))
+
+            # wait for the oldest upload once we're far enough ahead
+            if len(pending) >= 2 * workers:
+                pending.popleft().result()
+
+        # wait for the rest, raising any errors
+        while pending:
+            pending.popleft().result()
+
+
+def post_attachment(k, n, b):
+    """
+    Upload an encoded image to a jira ticket, with the JIRA session of the
+    current thread (see tickets.get_thread_session)
+    :params k: JIRA ticket key
+    :params n: filename for image to be uploaded as, should end with .png
+    :params b: Bytes object of the image
+    """
+
     # make the url to send the request to
     url = jira_config['url'] + '/rest/api/2/issue/' + k + '/attachments'
 
-    # try to post the request, including conversion of the Numpy array to a
-    # Bytes object
+    # try to post the request
     try:
-        r = s.post(url, files={
-            'file': (n, array_to_png(i))
+        r = tickets.get_thread_session().post(url, files={
+            'file': (n, b)
         }, headers={"X-Atlassian-Token": "nocheck"})
-        r.raise_for_status
+        r.raise_for_status()
 
     # if this doesn't work, exit
     except requests.exceptions.RequestException as e:
@@ -77,19 +124,13 @@ def upload_attachment(k, n, i):
 
 def array_to_png(arr):
     """
-    convert numpy array to a PNG bytes object for upload
+    convert numpy array to a PNG bytes object for upload, with the
+    compression and quantisation set in png_config
     :params arr: Numpy array
     :returns: Bytes object with PNG format
     """
 
-    # create the Bytes object
-    b = io.BytesIO()
-
-    # fill it with the Image generated from the array
-    Image.fromarray(arr).save(b, format='PNG')
-
-    # return the Bytes value
-    return b.getvalue()
+    return encode.encode_png(arr)
 
 
 class Ticket:
@@ -148,12 +189,14 @@ class Ticket:
 
         # if there are any attachments added to the ticket
         if len(self.ticket_image_attachments):
-            # upload each one
-            for i in self.ticket_image_attachments:
-                upload_attachment(self.ticket_key, i[0], i[1])
+            # upload them all concurrently
+            st = time.perf_counter()
+            upload_attachments(self.ticket_key, self.ticket_image_attachments,
+                               jira_upload_config['workers'])
 
-            LOGGER.info('%s attachments added',
-                        len(self.ticket_image_attachments))
+            LOGGER.info('%s attachments added to %s in %.2fs',
+                        len(self.ticket_image_attachments), self.ticket_key,
+                        time.perf_counter() - st)
 
 
 class InspectionTicket(Ticket):
@@ -214,11 +257,6 @@ class InspectionTicket(Ticket):
         self.tracking_db_ticket = tk_db.Ticket(
             ticket_assignee=self.assignee, ticket_status='new')
 
-        # add in the Attachment.index_attachment for each of the attachments
-        # featured in the ticket
-        self.tracking_db_ticket.attachment = [
-            x.index_attachment for x in attachment_objects]
-
         # add the object into the session
         session.add(self.tracking_db_ticket)
         session.flush()
@@ -226,17 +264,23 @@ class InspectionTicket(Ticket):
         # update the ticket_id
         self.ticket_id = self.tracking_db_ticket.ticket_id
 
+        # link each of the attachments featured in the ticket
+        for x in attachment_objects:
+            x.tk_db_attachment.ticket_id = self.ticket_id
+
 
 class ErrorTicket(Ticket):
     """
     An error ticket inheriting from the Ticket class
     """
 
-    def __init__(self, session, attachment_object):
+    def __init__(self, session, attachment_object, writer=None):
         """
         initiate a new instance of Error Ticket
         :params session: a SQLalchemy session
         :params attachment_object: an instance of attachment.Attachment
+        :params writer: optional bulk.BulkWriter to add the tk_db.Error row
+        to, rather than adding it to the session
         """
 
         LOGGER.debug("Creating new instance of ErrorTicket")
@@ -251,13 +295,24 @@ class ErrorTicket(Ticket):
         self.tracking_db_ticket = tk_db.Ticket(ticket_assignee=self.assignee,
                                                ticket_status='error')
 
-        # add in reference for the Attachment.index_attachment
-        self.tracking_db_ticket.errors = [
-            tk_db.Error(attachment_error=attachment_object.index_attachment)]
-
         # add the object to the session
         session.add(self.tracking_db_ticket)
-        session.flush()
 
-        # update the ticket_id
-        self.ticket_id = self.tracking_db_ticket.ticket_id
+        # if we've got a bulk writer add the error row to it, the ticket_id
+        # isn't known until the ticket is flushed so it's looked up at write
+        # time
+        if writer is not None:
+
+            writer.add(tk_db.Error,
+                       attachment_uid=attachment_object.tk_db_attachment.uid,
+                       ticket_id=lambda: self.tracking_db_ticket.ticket_id)
+
+        else:
+
+            # add in reference for the tk_db.Attachment
+            self.tracking_db_ticket.errors = [
+                tk_db.Error(attachment_error=attachment_object.tk_db_attachment)]
+            session.flush()
+
+            # update the ticket_id
+            self.ticket_id = self.tracking_db_ticket.ticket_id
@@ -0,0 +1,196 @@
+"""
+provides a persistent store of the raw grayscale pages of each attachment,
+keyed by attachment uid, so pages can be cropped again (e.g. for
+re-inspection or when the crop coordinates change) without downloading and
+rasterising the file again. Pages are read back memory mapped, so a crop
+only reads the part of the page it covers
+
+Each attachment is a single file laid out as:
+    MAGIC, a little endian uint32 header length, a JSON header listing the
+    shape, dtype, DPI and data offset of each page, then the raw pages (each
+    starting on a 64 byte boundary)
+"""
+import json
+import logging
+import os
+import struct
+import numpy as np
+import local_config
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'CIRS'
+LENGTH = struct.Struct('<I')
+ALIGN = 64
+
+
+def align(n):
+    """
+    :params n: byte offset
+    :returns: the offset rounded up to the next ALIGN byte boundary
+    """
+
+    return -(-n // ALIGN) * ALIGN
+
+
+class PageStore:
+    """
+    A store of raw grayscale pages on the local filesystem, one file per
+    attachment
+
+    Attributes:
+        root: the folder holding the page files
+    """
+
+    def __init__(self, root):
+        """
+        create a new instance of PageStore
+        :params root: the folder holding the page files
+        """
+
+        LOGGER.debug('Creating new instance of PageStore in %s', root)
+
+        self.root = root
+
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, uid):
+        """
+        get the file for an attachment
+        :params uid: the attachment uid
+        :returns: path to the file
+        """
+
+        return '%s/%s.raw' % (self.root, uid)
+
+    def put(self, uid, pages, dpis):
+        """
+        store the pages of an attachment, through a temporary file so a
+        partial file is never left in place
+        :params uid: the attachment uid
+        :params pages: list of grayscale numpy arrays
+        :params dpis: list of the resolution each page was rendered at
+        """
+
+        LOGGER.debug('Received call to put for %s - %s pages', uid,
+                     len(pages))
+
+        pages = [np.ascontiguousarray(x) for x in pages]
+
+        # work out where each page goes, the header length depends on the
+        # offsets so leave room for them to grow
+        header = [{'shape': list(x.shape), 'dtype': x.dtype.str,
+                   'dpi': int(d), 'offset': 0} for x, d in zip(pages, dpis)]
+        n = len(json.dumps({'pages': header})) + 32 * len(pages) + 64
+        offset = align(len(MAGIC) + LENGTH.size + n)
+
+        for h, x in zip(header, pages):
+            h['offset'] = offset
+            offset = align(offset + x.nbytes)
+
+        h = json.dumps({'pages': header}).encode().ljust(n)
+
+        f = self.path(uid)
+
+        with open(f + '.tmp', 'wb') as o:
+
+            o.write(MAGIC + LENGTH.pack(n) + h)
+
+            for p, x in zip(header, pages):
+                o.seek(p['offset'])
+                o.write(x.tobytes())
+
+            # pad the end so every page is within the file
+            o.truncate(offset)
+
+        os.replace(f + '.tmp', f)
+
+    def read_header(self, uid):
+        """
+        read the header of an attachment's file
+        :params uid: the attachment uid
+        :returns: list of dictionaries of shape, dtype, dpi and offset, one
+        per page, None if the attachment isn't in the store
+        """
+
+        try:
+
+            with open(self.path(uid), 'rb') as f:
+
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise ValueError('%s is not a page store file' % f.name)
+
+                n, = LENGTH.unpack(f.read(LENGTH.size))
+
+                return json.loads(f.read(n).decode())['pages']
+
+        except FileNotFoundError:
+            return None
+
+    def get(self, uid):
+        """
+        get the pages of an attachment, memory mapped
+        :params uid: the attachment uid
+        :returns: tuple of list of grayscale numpy arrays and list of the
+        resolution of each, None if the attachment isn't in the store
+        """
+
+        LOGGER.debug('Received call to get for %s', uid)
+
+        header = self.read_header(uid)
+
+        if header is None:
+            return None
+
+        f = self.path(uid)
+
+        return ([np.memmap(f, dtype=np.dtype(h['dtype']), mode='r',
+                           offset=h['offset'], shape=tuple(h['shape']))
+                 for h in header],
+                [h['dpi'] for h in header])
+
+    def get_page(self, uid, p):
+        """
+        get a single page of an attachment, memory mapped, so only the parts
+        of it that are used (e.g. a crop) are read
+        :params uid: the attachment uid
+        :params p: page number
+        :returns: tuple of grayscale numpy array and its resolution, None if
+        the page isn't in the store
+        """
+
+        LOGGER.debug('Received call to get_page for %s page %s', uid, p)
+
+        header = self.read_header(uid)
+
+        if header is None or not 1 <= p <= len(header):
+            return None
+
+        h = header[p - 1]
+
+        return (np.memmap(self.path(uid), dtype=np.dtype(h['dtype']),
+                          mode='r', offset=h['offset'],
+                          shape=tuple(h['shape'])),
+                h['dpi'])
+
+
+# the page store for this process, created on first use
+page_store = None
+
+
+def get_store():
+    """
+    get the page store for this process, as configured by
+    local_config.page_store_config
+    :returns: PageStore, None if the store is turned off
+    """
+
+    global page_store
+
+    if local_config.page_store_config['dir'] is None:
+        return None
+
+    if page_store is None:
+        page_store = PageStore(local_config.page_store_config['dir'])
+
+    return page_store
@@ -0,0 +1,157 @@
+"""
+provides a streaming pipeline for processing attachments, each of the
+stages (fetch > rasterise > analyse > export) is a generator feeding the next
+so only a bounded number of attachments are in flight at once. Downloads run
+on a background thread a bounded number of attachments ahead, so the download
+of attachment N+1 overlaps the rasterisation of attachment N. The persist
+stage is left to the coordinator as it needs the SQLAlchemy session
+"""
+import collections
+import concurrent.futures
+import logging
+import time
+from modules import pool
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in each stage of the pipeline
+
+    Attributes:
+        totals: dictionary of stage name to total seconds spent in the stage
+        counts: dictionary of stage name to number of attachments processed
+    """
+
+    def __init__(self):
+
+        self.totals = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+
+    def add(self, stage, seconds):
+        """
+        add time to a stage
+        :params stage: name of the stage
+        :params seconds: time spent on a single attachment
+        """
+
+        self.totals[stage] = self.totals.get(stage, 0) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def log_summary(self):
+        """
+        log the total and mean time spent in each stage
+        """
+
+        for k in self.totals:
+            LOGGER.info('Stage %s - %s attachments in %.2fs (%.3fs each)',
+                        k, self.counts[k], self.totals[k],
+                        self.totals[k] / self.counts[k])
+
+
+def timed_download(b, k):
+    """
+    download an S3 object to a temporary file, timing how long it takes
+    :params b: bucket name
+    :params k: object key
+    :returns: tuple of download path (None if it failed) and seconds taken
+    """
+
+    st = time.perf_counter()
+    path = pool.download_attachment(b, k)
+
+    return path, time.perf_counter() - st
+
+
+def fetch_stage(attachments, timer, prefetch=2):
+    """
+    fetch stage - download attachments on a background thread, keeping up to
+    prefetch downloads ahead of the consumer
+    :params attachments: iterable of attachment.Attachment instances created
+    with process=False
+    :params timer: StageTimer to record the download times in
+    :params prefetch: number of attachments to download ahead
+    :returns: generator of attachment.Attachment instances
+    """
+
+    def finish(a, f):
+        """
+        wait for a download to finish and apply it to the attachment
+        """
+
+        if f is not None:
+            path, seconds = f.result()
+            timer.add('fetch', seconds)
+            a.apply_download(path)
+
+        return a
+
+    with concurrent.futures.ThreadPoolExecutor(1) as ex:
+
+        pending = collections.deque()
+
+        for a in attachments:
+
+            # start the download if we've got an S3 object to download,
+            # otherwise the file is held inline in the GR database and has to
+            # be loaded here as it needs the session
+            if a.s3_object is not None:
+                f = ex.submit(timed_download, a.s3_object.bucket_name,
+                              a.s3_object.key)
+            else:
+                a.fetch()
+                f = None
+
+            pending.append((a, f))
+
+            # once we're far enough ahead hand back the oldest attachment
+            if len(pending) > prefetch:
+                yield finish(*pending.popleft())
+
+        # hand back whatever is left
+        while pending:
+            yield finish(*pending.popleft())
+
+
+def run_stage(attachments, stage, timer):
+    """
+    run one of the attachment.Attachment stage methods over each attachment
+    :params attachments: iterable of attachment.Attachment instances
+    :params stage: name of the stage method, e.g. rasterise
+    :params timer: StageTimer to record the stage times in
+    :returns: generator of attachment.Attachment instances
+    """
+
+    for a in attachments:
+
+        st = time.perf_counter()
+        getattr(a, stage)()
+        timer.add(stage, time.perf_counter() - st)
+
+        yield a
+
+
+def run_pipeline(attachments, prefetch=2):
+    """
+    chain the stages together over a stream of attachments, logging the time
+    spent in each stage once the stream is exhausted
+    :params attachments: iterable of attachment.Attachment instances created
+    with process=False, can be a generator so they are created lazily
+    :params prefetch: number of attachments to download ahead, 0 downloads
+    each attachment only when it is needed
+    :returns: generator of processed attachment.Attachment instances
+    """
+
+    LOGGER.debug('Received call to run_pipeline with prefetch %s', prefetch)
+
+    timer = StageTimer()
+
+    g = fetch_stage(attachments, timer, prefetch)
+
+    for stage in ['rasterise', 'analyse', 'export']:
+        g = run_stage(g, stage, timer)
+
+    yield from g
+
+    timer.log_summary()
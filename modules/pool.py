@@ -0,0 +1,217 @@
+"""
+provides a worker pool for processing attachments concurrently, downloads
+from the S3 Bucket are run in a thread pool and the rasterisation and export
+of pages in a process pool. The SQLAlchemy session is never passed to the
+workers, all database writes stay with the coordinator
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import tempfile
+import threading
+from botocore.exceptions import ClientError
+from modules import s3, attachment
+
+LOGGER = logging.getLogger(__name__)
+
+# boto3 resources aren't thread safe, so each download thread gets its own
+# S3 connection
+thread_data = threading.local()
+
+
+def get_thread_s3():
+    """
+    get the S3 connection for the current thread, creating it if needed
+    :returns: S3 service resource
+    """
+
+    if not hasattr(thread_data, 's3'):
+
+        LOGGER.debug('Creating S3 connection for thread %s',
+                     threading.current_thread().name)
+
+        thread_data.s3 = s3.connect_to_s3()
+
+    return thread_data.s3
+
+
+def download_attachment(b, k):
+    """
+    download an S3 object to a temporary file
+    :params b: bucket name
+    :params k: object key
+    :returns: path to the temporary file, None if the download failed
+    """
+
+    LOGGER.debug('Received call to download_attachment - %s : %s', b, k)
+
+    # create a temporary file to download to
+    f = tempfile.NamedTemporaryFile(delete=False)
+
+    # try to download the s3 object to the temporary file
+    try:
+
+        get_thread_s3().Object(b, k).download_fileobj(f)
+        return f.name
+
+    # if we encounter an error tidy up the temporary file
+    except ClientError as e:
+
+        LOGGER.debug('Download of %s failed - %s', k, e)
+        f.close()
+        os.remove(f.name)
+        return None
+
+    finally:
+
+        f.close()
+
+
+class Job:
+    """
+    An attachment in flight through the pool
+
+    Attributes:
+        attachment: the attachment.Attachment instance
+        download: Future of the download path, None if the file didn't need
+        downloading
+        path: location of the downloaded file once known, None if there isn't
+        one
+        render: Future of the render_file output once submitted
+    """
+
+    def __init__(self, attachment, download=None, path=None):
+
+        self.attachment = attachment
+        self.download = download
+        self.path = path
+        self.render = None
+
+    def start_render(self, process_pool):
+        """
+        submit the file to the process pool to be rendered, if it has been
+        downloaded and hasn't been submitted already
+        :params process_pool: concurrent.futures.ProcessPoolExecutor
+        """
+
+        if self.render is not None:
+            return
+
+        if self.download is not None:
+
+            if not self.download.done():
+                return
+
+            self.path = self.download.result()
+            self.download = None
+
+        if self.path is not None:
+            a = self.attachment
+            self.render = process_pool.submit(
+                attachment.render_file, a.attachment_id, self.path,
+                a.render_threads)
+
+
+def process_attachments(attachments, workers):
+    """
+    download and render attachments concurrently, results are applied back to
+    each attachment on the calling thread in the order given so the outcome
+    matches a serial run. Only about twice as many attachments as workers are
+    in flight at once, and all renders are submitted from the calling thread
+    :params attachments: list of attachment.Attachment instances created with
+    process=False
+    :params workers: number of download threads and render processes
+    :returns: generator of the processed attachment.Attachment instances
+    """
+
+    LOGGER.info('Processing %s attachments with %s workers',
+                len(attachments), workers)
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pp, \
+            concurrent.futures.ThreadPoolExecutor(workers) as tp:
+
+        # start the render processes before any download threads exist, so
+        # they aren't forked while boto3 is in use
+        pp.submit(os.getpid).result()
+
+        pending = collections.deque()
+
+        def start_renders():
+            """
+            submit the renders of any attachments that have finished
+            downloading
+            """
+
+            for j in pending:
+                j.start_render(pp)
+
+        def finish(j):
+            """
+            wait for an attachment to be downloaded and rendered, starting
+            the renders of others as their downloads finish, then apply the
+            results to it
+            """
+
+            a = j.attachment
+
+            while True:
+
+                j.start_render(pp)
+                start_renders()
+
+                if j.render is not None or (j.download is None and
+                                            j.path is None):
+                    break
+
+                # wait for a download to finish
+                concurrent.futures.wait(
+                    [x.download for x in pending if x.download is not None] +
+                    [j.download],
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+            # keep starting renders as downloads finish while this one runs
+            while j.render is not None and not j.render.done():
+
+                concurrent.futures.wait(
+                    [x.download for x in pending if x.download is not None] +
+                    [j.render],
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                start_renders()
+
+            if a.s3_object is not None:
+                a.apply_download(j.path)
+
+            if j.render is not None:
+                a.apply_render(j.render.result())
+
+            # if we didn't pick up any errors then can delete the file
+            if not a.errored and hasattr(a, 'path'):
+                a.delete_temp_file()
+
+            return a
+
+        for a in attachments:
+
+            # files held inline in the GR database have to be loaded here as
+            # it needs the session, so only the rendering goes to the pool
+            if a.s3_object is None:
+                a.fetch()
+                j = Job(a, path=getattr(a, 'path', None))
+
+            else:
+                j = Job(a, tp.submit(download_attachment,
+                                     a.s3_object.bucket_name,
+                                     a.s3_object.key))
+
+            pending.append(j)
+            start_renders()
+
+            # once we're far enough ahead hand back the oldest attachment,
+            # dropping our reference to its pages
+            if len(pending) >= 2 * workers:
+                yield finish(pending.popleft())
+
+        # hand back whatever is left
+        while pending:
+            yield finish(pending.popleft())
@@ -0,0 +1,187 @@
+"""
+provides functions for rasterising pdf pages with poppler (via pdf2image),
+rendering only the pages needed at the resolution they are needed at
+"""
+import logging
+import os
+import numpy as np
+import pdf2image
+from PIL import Image
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_page_count(path):
+    """
+    get the number of pages in a pdf without rendering it
+    :params path: location of the pdf
+    :returns: number of pages
+    """
+
+    LOGGER.debug('Received call to get_page_count for %s', path)
+
+    return pdf2image.pdfinfo_from_path(path)['Pages']
+
+
+def render_pages(path, first_page=None, last_page=None, dpi=200,
+                 thread_count=1):
+    """
+    render a range of pages of a pdf straight to grayscale by poppler
+    :params path: location of the pdf
+    :params first_page: first page to render, None starts at the first page
+    :params last_page: last page to render, None ends at the last page
+    :params dpi: resolution to render the pages at
+    :params thread_count: number of poppler processes to split the pages
+    across
+    :returns: list of grayscale numpy arrays
+    """
+
+    LOGGER.debug('Received call to render_pages for %s; pages %s-%s at %s dpi',
+                 path, first_page, last_page, dpi)
+
+    i = pdf2image.convert_from_path(path, dpi=dpi, first_page=first_page,
+                                    last_page=last_page, grayscale=True,
+                                    thread_count=thread_count)
+
+    return [np.array(x) for x in i]
+
+
+def render_pages_to_folder(path, folder, prefix, first_page=None,
+                           last_page=None, dpi=200, fmt='pgm', thread_count=1):
+    """
+    render a range of pages of a pdf straight to grayscale image files by
+    poppler, without loading them into memory. Files are named
+    <prefix>_<page number>.<fmt>
+    :params path: location of the pdf
+    :params folder: folder to write the image files to
+    :params prefix: prefix for the image file names
+    :params first_page: first page to render, None starts at the first page
+    :params last_page: last page to render, None ends at the last page
+    :params dpi: resolution to render the pages at
+    :params fmt: image file format, either pgm or png
+    :params thread_count: number of poppler processes to split the pages
+    across
+    :returns: list of paths to the image files
+    """
+
+    LOGGER.debug('Received call to render_pages_to_folder for %s; pages %s-%s at %s dpi to %s',
+                 path, first_page, last_page, dpi, folder)
+
+    if first_page is None:
+        first_page = 1
+
+    # pdf2image finds the files it rendered by prefix, so make one unique to
+    # this page range, each poppler process adds a counter to it so the files
+    # come back in page order
+    r = pdf2image.convert_from_path(path, dpi=dpi, first_page=first_page,
+                                    last_page=last_page, grayscale=True,
+                                    fmt='ppm' if fmt == 'pgm' else fmt,
+                                    output_folder=folder,
+                                    output_file='render_%s_' % first_page,
+                                    paths_only=True, thread_count=thread_count)
+
+    # rename the files to include the page number
+    paths = []
+    for i in range(len(r)):
+        fn = '%s/%s_%s.%s' % (folder, prefix, first_page + i, fmt)
+        os.replace(r[i], fn)
+        paths.append(fn)
+
+    return paths
+
+
+def map_pgm(path):
+    """
+    memory map a binary (P5) pgm file, so pixels are only read from disk when
+    they are accessed
+    :params path: location of the pgm file
+    :returns: read-only numpy memmap of the image
+    """
+
+    # read the header - magic number, width, height and maxval separated by
+    # whitespace, with optional comments
+    with open(path, 'rb') as f:
+        b = f.read(512)
+
+    fields = []
+    i = 0
+    while len(fields) < 4:
+
+        if b[i:i + 1] == b'#':
+            i = b.index(b'\n', i)
+        elif b[i:i + 1].isspace():
+            i += 1
+        else:
+            j = i
+            while not b[j:j + 1].isspace():
+                j += 1
+            fields.append(b[i:j])
+            i = j
+
+    # a single whitespace character separates the header from the pixels
+    assert fields[0] == b'P5', '%s is not a binary pgm file' % path
+    w, h, maxval = [int(x) for x in fields[1:]]
+
+    return np.memmap(path, mode='r', offset=i + 1, shape=(h, w),
+                     dtype=np.uint8 if maxval < 256 else '>u2')
+
+
+def load_page(path):
+    """
+    load a page image as a grayscale numpy array, pgm files are memory mapped
+    rather than read
+    :params path: location of the image file
+    :returns: grayscale numpy array
+    """
+
+    if path.endswith('.pgm'):
+        return map_pgm(path)
+
+    return np.array(Image.open(path).convert('L'))
+
+
+def render_targeted(path, inspection_pages=1, inspection_dpi=200,
+                    check_dpi=72, folder=None, prefix=None, fmt='pgm',
+                    thread_count=1):
+    """
+    render the pages that are inspected at high resolution and the remaining
+    pages, which are only used for empty page checks and archive images, at
+    low resolution
+    :params path: location of the pdf
+    :params inspection_pages: number of pages from the start of the document
+    that are inspected
+    :params inspection_dpi: resolution to render the inspected pages at
+    :params check_dpi: resolution to render the remaining pages at
+    :params folder: if given the pages are rendered to image files in this
+    folder (see render_pages_to_folder) rather than into memory
+    :params prefix: prefix for the image file names if rendering to folder
+    :params fmt: image file format if rendering to folder
+    :params thread_count: number of poppler processes to split each range of
+    pages across
+    :returns: list of grayscale numpy arrays, or list of paths to the image
+    files if rendering to folder
+    """
+
+    LOGGER.debug('Received call to render_targeted for %s', path)
+
+    def render(first_page, last_page, dpi):
+        """
+        render a range of pages either into memory or to folder
+        """
+
+        if folder is None:
+            return render_pages(path, first_page, last_page, dpi,
+                                thread_count)
+        return render_pages_to_folder(path, folder, prefix, first_page,
+                                      last_page, dpi, fmt, thread_count)
+
+    n = get_page_count(path)
+
+    # render the inspected pages
+    pages = render(1, min(inspection_pages, n), inspection_dpi)
+
+    # render any remaining pages
+    if n > inspection_pages:
+        pages += render(inspection_pages + 1, n, check_dpi)
+
+    return pages
@@ -0,0 +1,184 @@
+"""
+provides the registry of crop templates, the regions of each version of the
+consent form to crop for the inspection ticket, and a resolver that finds the
+form version of a batch of attachments through the GR consent tables
+"""
+import collections
+import logging
+from models import gr_db
+from modules import uids
+import local_config
+
+LOGGER = logging.getLogger(__name__)
+
+# a region of a form to crop, as the arguments of Attachment.crop_png
+Region = collections.namedtuple('Region', ['name', 'page', 'x', 'y', 'w', 'h',
+                                           'fw'])
+
+
+def make_region(r):
+    """
+    make a Region from a region dictionary, checking it describes a region of
+    a page and that its name can't overwrite a page image
+    :params r: dictionary of name, page, x, y, w, h and fw
+    :returns: Region
+    """
+
+    r = Region(**r)
+
+    # crops are saved as <uid>_<name>.png alongside the page exports, which
+    # are <uid>_<page number>.png
+    if not str(r.name) or str(r.name).isdigit():
+        raise ValueError('Crop region name %s would clash with a page image' %
+                         r.name)
+
+    if not isinstance(r.page, int) or r.page < 1:
+        raise ValueError('Crop region %s page must be 1 or more' % r.name)
+
+    if not all(0 <= v <= 1 for v in (r.x, r.y, r.w, r.h)) or \
+            not r.w or not r.h or r.x == 1 or r.y == 1:
+        raise ValueError('Crop region %s x, y, w and h must be in 0-1 range '
+                         'and leave part of the page to crop' % r.name)
+
+    if not isinstance(r.fw, int) or r.fw < 1:
+        raise ValueError('Crop region %s fw must be 1 or more' % r.name)
+
+    return r
+
+
+def normalise(k):
+    """
+    :params k: form version or title
+    :returns: key for the template index, None if there's nothing to match on
+    """
+
+    if k is None or not str(k).strip():
+        return None
+
+    return str(k).strip().lower()
+
+
+class TemplateRegistry:
+    """
+    The crop templates for each form version, indexed once when created
+
+    Attributes:
+        index: dictionary of normalised form version or title to tuple of
+        Region
+        default: tuple of Region used for forms that don't match a template
+        max_page: the highest page number any template takes a region from
+    """
+
+    def __init__(self, templates):
+        """
+        create a new instance of TemplateRegistry
+        :params templates: dictionary of form version or title to list of
+        region dictionaries (name, page, x, y, w, h and fw), must include
+        default
+        """
+
+        LOGGER.debug('Creating new instance of TemplateRegistry with %s templates',
+                     len(templates))
+
+        self.index = {normalise(k): tuple(make_region(r) for r in v)
+                      for k, v in templates.items() if k != 'default'}
+        self.default = tuple(make_region(r) for r in templates['default'])
+        self.max_page = max([r.page for v in self.index.values() for r in v] +
+                            [r.page for r in self.default] + [1])
+
+    def lookup(self, version=None, title=None):
+        """
+        get the regions to crop for a form, matching on version first then
+        title
+        :params version: ConsentQuestionnaire version
+        :params title: ConsentQuestionnaire title
+        :returns: tuple of Region
+        """
+
+        for k in (version, title):
+            t = self.index.get(normalise(k))
+            if t is not None:
+                return t
+
+        return self.default
+
+
+# the registry for this process, created on first use
+registry = None
+
+
+def get_registry():
+    """
+    get the template registry for this process, as configured by
+    local_config.crop_templates
+    :returns: TemplateRegistry
+    """
+
+    global registry
+
+    if registry is None:
+        registry = TemplateRegistry(local_config.crop_templates)
+
+    return registry
+
+
+def get_form_versions(session, attachment_uids, chunk_size=1000):
+    """
+    get the consent form version and title for a batch of attachments from
+    the GR database, joining each attachment to the questionnaire response of
+    its consent, in as few queries as possible
+    :params session: a SQLAlchemy session
+    :params attachment_uids: iterable of attachment uids
+    :params chunk_size: number of attachments to query at once
+    :returns: dictionary of attachment uid to tuple of (version, title) of
+    the latest questionnaire response, attachments that can't be joined to a
+    questionnaire are left out
+    """
+
+    u = uids.valid_uids(attachment_uids, 'attachment')
+
+    LOGGER.debug('Received call to get_form_versions for %s attachments',
+                 len(u))
+
+    d = {}
+
+    for i in range(0, len(u), chunk_size):
+
+        q = session.query(gr_db.CdrContent.attachment_uid,
+                          gr_db.ConsentQuestionnaire.version,
+                          gr_db.ConsentQuestionnaire.title).\
+            join(gr_db.ConsentDocumentReference,
+                 gr_db.ConsentDocumentReference.uid ==
+                 gr_db.CdrContent.consent_document_reference_uid).\
+            join(gr_db.ConsentQuestionnaireResponse,
+                 gr_db.ConsentQuestionnaireResponse.consent_uid ==
+                 gr_db.ConsentDocumentReference.consent_uid).\
+            join(gr_db.ConsentQuestionnaire,
+                 gr_db.ConsentQuestionnaire.uid ==
+                 gr_db.ConsentQuestionnaireResponse.consent_questionnaire_uid).\
+            filter(gr_db.CdrContent.attachment_uid.in_(u[i:i + chunk_size])).\
+            order_by(gr_db.ConsentQuestionnaireResponse.
+                     consent_questionnaire_response_authored)
+
+        # ordered by when the response was authored so the latest wins
+        d.update({str(x[0]): tuple(x[1:]) for x in q})
+
+    LOGGER.info('Got form versions of %s of %s attachments', len(d), len(u))
+
+    return d
+
+
+def resolve_templates(session, attachment_uids):
+    """
+    get the regions to crop for each of a batch of attachments
+    :params session: a SQLAlchemy session
+    :params attachment_uids: iterable of attachment uids
+    :returns: dictionary of attachment uid to tuple of Region, every
+    attachment is included (those without a known version get the default)
+    """
+
+    r = get_registry()
+    v = get_form_versions(session, attachment_uids)
+
+    return {str(x): r.lookup(*v.get(str(x), (None, None)))
+            for x in attachment_uids}
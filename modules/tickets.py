@@ -4,9 +4,14 @@ also provides two classes for instances of JIRA tickets that
 either exist in the database already or are unknown to it
 """
 import requests
+import concurrent.futures
 import datetime
 import sys
 import logging
+import threading
+import time
+import urllib.parse
+from dateutil import tz
 from local_config import jira_config
 from models import tk_db
 
@@ -22,21 +27,143 @@ except requests.exceptions.RequestException as e:
     LOGGER.critical("Unable to establish session with JIRA - %s" % e)
     sys.exit(1)
 
+# requests sessions aren't guaranteed to be thread safe, so each thread
+# fetching tickets gets its own
+thread_data = threading.local()
 
-def get_ticket(k):
+
+def get_thread_session():
+    """
+    get the JIRA session for the current thread, creating it if needed
+    :returns: requests.Session
+    """
+
+    if not hasattr(thread_data, 's'):
+
+        LOGGER.debug('Creating JIRA session for thread %s',
+                     threading.current_thread().name)
+
+        thread_data.s = requests.Session()
+        thread_data.s.auth = (jira_config['user'], jira_config['password'])
+
+    return thread_data.s
+
+
+# the time zone JIRA reads JQL dates in, looked up on first use
+user_timezone = None
+
+
+def get_user_timezone():
+    """
+    get the time zone of the JIRA user, which JQL dates are read in
+    :returns: tzinfo, UTC if JIRA doesn't give one
+    """
+
+    global user_timezone
+
+    if user_timezone is None:
+
+        r = s.get('%s/rest/api/2/myself' % jira_config['url'])
+        r.raise_for_status()
+
+        z = r.json().get('timeZone')
+        user_timezone = (tz.gettz(z) if z else None) or tz.UTC
+
+        LOGGER.debug('JIRA user time zone is %s', z)
+
+    return user_timezone
+
+
+def parse_jira_time(v):
+    """
+    convert a JIRA timestamp to UTC
+    :params v: timestamp as JIRA returns it, e.g. 2020-07-01T09:30:00.000+0100
+    :returns: naive datetime in UTC
+    """
+
+    d = datetime.datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f%z')
+
+    return d.astimezone(tz.UTC).replace(tzinfo=None)
+
+
+def latest_updated(details):
+    """
+    get the time the most recently updated of a batch of tickets was updated
+    :params details: dictionary of ticket key to ticket fields, including
+    updated
+    :returns: naive datetime in UTC, None if there are no tickets
+    """
+
+    u = [parse_jira_time(x['updated']) for x in details.values()
+         if x.get('updated')]
+
+    return max(u) if u else None
+
+
+class RateLimiter:
+    """
+    Spreads calls out over time so no more than rate of them start each
+    second, shared between threads
+
+    Attributes:
+        interval: minimum number of seconds between the start of calls
+        next_time: the time (from time.monotonic) the next call can start
+    """
+
+    def __init__(self, rate=None):
+        """
+        create a new instance of RateLimiter
+        :params rate: maximum number of calls per second, None for no limit
+        """
+
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        block until the next call is allowed to start
+        """
+
+        # book the next slot, then sleep outside of the lock until it comes
+        with self.lock:
+            now = time.monotonic()
+            t = max(now, self.next_time)
+            self.next_time = t + self.interval
+
+        if t > now:
+            time.sleep(t - now)
+
+
+def get_ticket(k, session=None, fields=None, expand=None):
     """
     make a call to JIRA REST API to get ticket details
     :params k: ticket key
+    :params session: requests.Session to use, defaults to the module session
+    :params fields: optional list of the fields to return, by default JIRA
+    returns every field
+    :params expand: optional list of the parts of the ticket to expand (e.g.
+    changelog, renderedFields), nothing is expanded by default
     :returns: dictionary of ticket fields
     """
 
     LOGGER.debug('Received call to get_ticket for %s', k)
 
-    # make request url
+    # make request url, only asking for the fields and expansions needed
     url = '%s/rest/api/2/issue/%s' % (jira_config['url'], k)
+    params = []
+
+    if fields is not None:
+        params.append('fields=%s' % ','.join(fields))
+
+    if expand is not None:
+        params.append('expand=%s' % ','.join(expand))
+
+    if len(params):
+        url = '%s?%s' % (url, '&'.join(params))
 
     # get ticket details
-    r = s.get(url)
+    r = (session or s).get(url)
     r.raise_for_status()
 
     LOGGER.debug('Made call to %s', url)
@@ -44,6 +171,102 @@ def get_ticket(k):
     return r.json()['fields']
 
 
+def fetch_tickets(keys, workers=8, rate=None, fields=None):
+    """
+    get the details of several tickets concurrently, each worker thread
+    making get_ticket calls with its own session
+    :params keys: list of ticket keys
+    :params workers: maximum number of requests in flight at once
+    :params rate: maximum number of requests started per second, None for no
+    limit
+    :params fields: optional list of the fields to return for each ticket
+    :returns: dictionary of ticket key to dictionary of ticket fields
+    """
+
+    LOGGER.debug('Received call to fetch_tickets for %s tickets, %s workers, rate %s',
+                 len(keys), workers, rate)
+
+    limiter = RateLimiter(rate)
+
+    def fetch(k):
+        """
+        wait for a slot then get the ticket details
+        """
+
+        limiter.wait()
+        return get_ticket(k, get_thread_session(), fields)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+        return dict(zip(keys, ex.map(fetch, keys)))
+
+
+def search_tickets(keys, fields=('status', 'assignee', 'updated'),
+                   chunk_size=100, workers=1, rate=None, updated_since=None):
+    """
+    get the details of many tickets through the JIRA search API, asking for
+    chunk_size tickets at a time with key in (...) queries rather than making
+    a call per ticket
+    :params keys: list of ticket keys
+    :params fields: the ticket fields to return
+    :params updated_since: optional naive datetime in UTC, only tickets
+    updated in JIRA since then are returned (JQL dates are to the minute, so
+    it is put in the JIRA user's time zone)
+    :params chunk_size: number of tickets to ask for in each query
+    :params workers: maximum number of queries in flight at once
+    :params rate: maximum number of queries started per second, None for no
+    limit
+    :returns: dictionary of ticket key to dictionary of ticket fields, keys
+    JIRA doesn't return (e.g. deleted tickets) are left out
+    """
+
+    LOGGER.debug('Received call to search_tickets for %s tickets', len(keys))
+
+    limiter = RateLimiter(rate)
+
+    if updated_since is not None:
+        updated_since = updated_since.replace(tzinfo=tz.UTC).\
+            astimezone(get_user_timezone())
+
+    def search(k):
+        """
+        wait for a slot then get all the pages of a key in (...) query
+        """
+
+        limiter.wait()
+
+        jql = 'key in (%s)' % ','.join(k)
+
+        if updated_since is not None:
+            jql = '%s and updated >= "%s"' % (
+                jql, updated_since.strftime('%Y/%m/%d %H:%M'))
+
+        jql = urllib.parse.quote(jql)
+        session = get_thread_session()
+
+        # get each page of matches, warning rather than failing on keys that
+        # no longer exist
+        out = []
+        while True:
+
+            r = get_jira_issues_page(jql, st=len(out), npp=chunk_size,
+                                     fields=fields, session=session,
+                                     validate_query='warn')
+            out = out + r['issues']
+
+            if not len(r['issues']) or len(out) >= r['total']:
+                return out
+
+    chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+        issues = [x for c in ex.map(search, chunks) for x in c]
+
+    LOGGER.info('%s of %s tickets read from JIRA in %s queries',
+                len(issues), len(keys), len(chunks))
+
+    return {x['key']: x['fields'] for x in issues}
+
+
 def list_jira_issues(jql):
     """
     Return all Jira issues matching a query, iterating over required number of
@@ -81,22 +304,32 @@ def list_jira_issues(jql):
     return [x['key'] for x in out]
 
 
-def get_jira_issues_page(jql, st, npp):
+def get_jira_issues_page(jql, st, npp, fields=None, session=None,
+                         validate_query=None):
     """
     Returns a single page of jql query matches
     :params jql: jira query language string
     :params st: start number of page
     :params npp: number of issues per page to return
+    :params fields: optional list of the fields to return for each issue
+    :params session: requests.Session to use, defaults to the module session
+    :params validate_query: optional JIRA validateQuery setting, e.g. warn
     """
 
     # create the request url
     url = '%s/rest/api/2/search?jql=%s&startAt=%s&maxResults=%s' %\
         (jira_config['url'], jql, st, npp)
 
+    if fields is not None:
+        url = '%s&fields=%s' % (url, ','.join(fields))
+
+    if validate_query is not None:
+        url = '%s&validateQuery=%s' % (url, validate_query)
+
     LOGGER.debug('Received call to getJiraIssuesPage function - %s' % url)
 
     try:
-        r = s.get(url)
+        r = (session or s).get(url)
         r.raise_for_status()
         return r.json()
 
@@ -110,17 +343,23 @@ class ExistingTicket:
     An existing JIRA ticket that was previously created and exists in db
     
     Attributes:
+        fields: the JIRA fields read from the ticket, the only ones requested
         tracker_db_ticket: instance of tk_db.Ticket
         key: the key of the JIRA ticket
         status: the current status of the JIRA ticket
         assignee: the current assignee of the JIRA ticket
     """
 
-    def __init__(self, tracker_db_ticket):
+    fields = ['status', 'assignee']
+
+    def __init__(self, tracker_db_ticket, details=None):
         """
         Initiate a new instance of Existing Ticket
         :params tracker_db_ticket: SQLAlchemy object corresponding to the
         ticket in the database
+        :params details: optional dictionary of ticket key to ticket fields
+        already fetched (e.g. by fetch_tickets), tickets missing from it are
+        treated as not found
         """
 
         LOGGER.debug('Making new instance of ExistingTicket')
@@ -128,8 +367,12 @@ class ExistingTicket:
         self.tracker_db_ticket = tracker_db_ticket
         self.key = tracker_db_ticket.ticket_key
 
-        # get the ticket details from JIRA
-        d = get_ticket(self.key)
+        # get the ticket details from JIRA, unless they've been fetched
+        # already
+        if details is None:
+            d = get_ticket(self.key, fields=self.fields)
+        else:
+            d = details.get(self.key)
 
         # if ticket exists then update attributes
         if d is not None:
@@ -166,6 +409,7 @@ class NewTicket:
     inspection)
     
     Attributes:
+        fields: the JIRA fields read from the ticket, the only ones requested
         key: the key of the JIRA ticket
         attachment_id: the ID of the attachment the ticket concerns
         status: the current status of the JIRA ticket
@@ -173,6 +417,8 @@ class NewTicket:
         tracker_db_ticket: instance of tk_db.Ticket
     """
 
+    fields = ['summary', 'status', 'assignee']
+
     def __init__(self, key):
         """
         Initiate a new instance of NewTicket with JIRA ticket key
@@ -183,7 +429,7 @@ class NewTicket:
         self.key = key
 
         # get ticket details
-        d = get_ticket(self.key)
+        d = get_ticket(self.key, fields=self.fields)
 
         # split title to get attachment ID
         l = d['summary'].split(' File ')
@@ -200,30 +446,44 @@ class NewTicket:
                     self.key, self.attachment_id)
 
 
-    def update_db(self, session, error_type):
+    def update_db(self, session, error_type, writer=None):
         """
         update the database with the ticket details
         :params session: SQLAlchemy session boudn to required engines
         :params error_type: type of error in the ticket
+        :params writer: optional bulk.BulkWriter to add the tk_db.Error row
+        to, rather than adding it to the session
         """
 
         LOGGER.debug('Updating database with ticket %s', self.key)
 
         # get the tk_db.Attachment object for attachment_id
         att = session.query(tk_db.Attachment).\
-            filter(tk_db.Attachment.attachment_id == self.attachment_id).\
+            filter(tk_db.Attachment.uid == self.attachment_id).\
             first()
 
         # add the tk_db.Ticket instance to session
         session.add(self.tracker_db_ticket)
 
-        # make new tk_db.Error instance, linking to the attachment and ticket
-        err = tk_db.Error(error_type=error_type)
-        err.attachment_error = att
-        err.ticket_error = self.tracker_db_ticket
+        # if we've got a bulk writer add the error row to it, the ticket_id
+        # isn't known until the ticket is flushed so it's looked up at write
+        # time
+        if writer is not None:
+
+            writer.add(tk_db.Error,
+                       attachment_uid=getattr(att, 'uid', None),
+                       error_type=error_type,
+                       ticket_id=lambda: self.tracker_db_ticket.ticket_id)
+
+        else:
+
+            # make new tk_db.Error instance, linking to the attachment and ticket
+            err = tk_db.Error(error_type=error_type)
+            err.attachment_error = att
+            err.ticket_error = self.tracker_db_ticket
 
-        # add it to the session
-        session.add(err)
+            # add it to the session
+            session.add(err)
 
         # update the tk_db.Ticket attributes
         self.tracker_db_ticket.ticket_status = self.status
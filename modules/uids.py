@@ -0,0 +1,29 @@
+"""
+provides the checks made on batches of uids before they are used in a
+query of the GR database
+"""
+import logging
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+
+def valid_uids(uids, kind):
+    """
+    get the distinct uids of a batch in a consistent form for an IN query,
+    leaving out anything that isn't a uid as it would fail the whole query
+    :params uids: iterable of uids
+    :params kind: what the uids are of, for the warning logged for each
+    invalid uid
+    :returns: sorted list of uid strings
+    """
+
+    u = set()
+
+    for i in uids:
+        try:
+            u.add(str(uuid.UUID(str(i))))
+        except ValueError:
+            LOGGER.warning('Invalid %s uid %s', kind, i)
+
+    return sorted(u)
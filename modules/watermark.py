@@ -0,0 +1,75 @@
+"""
+provides functions for reading and advancing the watermarks (persisted
+cursors) held in the tracker database, so incremental processes only look at
+rows changed since their last successful run
+"""
+import datetime
+import logging
+from models import tk_db
+
+LOGGER = logging.getLogger(__name__)
+
+# whether the sync_state table has been checked for in this process
+table_checked = False
+
+
+def check_table(session):
+    """
+    create the sync_state table if it doesn't exist yet, so an existing
+    tracker db picks it up without being recreated. Only checked once per
+    process
+    :params session: SQLAlchemy session bound to the tracker db
+    """
+
+    global table_checked
+
+    if not table_checked:
+
+        LOGGER.debug('Checking for the sync_state table')
+
+        tk_db.SyncState.__table__.create(
+            session.get_bind(tk_db.SyncState), checkfirst=True)
+        table_checked = True
+
+
+def get_watermark(session, name):
+    """
+    get the current value of a watermark
+    :params session: SQLAlchemy session bound to the tracker db
+    :params name: name of the watermark
+    :returns: datetime of the watermark, None if it hasn't been set
+    """
+
+    LOGGER.debug('Received call to get_watermark for %s', name)
+
+    check_table(session)
+
+    r = session.query(tk_db.SyncState).get(name)
+
+    if r is None:
+        return None
+
+    return r.sync_watermark
+
+
+def set_watermark(session, name, value):
+    """
+    set the value of a watermark, it is persisted when the session is
+    committed
+    :params session: SQLAlchemy session bound to the tracker db
+    :params name: name of the watermark
+    :params value: datetime to set the watermark to
+    """
+
+    LOGGER.debug('Received call to set_watermark for %s - %s', name, value)
+
+    check_table(session)
+
+    r = session.query(tk_db.SyncState).get(name)
+
+    if r is None:
+        r = tk_db.SyncState(sync_name=name)
+        session.add(r)
+
+    r.sync_watermark = value
+    r.sync_updated = datetime.datetime.today()